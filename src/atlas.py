@@ -0,0 +1,129 @@
+import struct
+import threading
+
+from cache import RenditionCache, DEFAULT_BUDGET, array_size
+from decoders import RenditionDecoder, RenditionDecoderError, \
+                     DEFAULT_MAX_MEMORY
+
+
+class AtlasCache(object):
+    """
+    Decoded atlases of one car file. Internal link renditions carry no pixels
+    of their own but a `CARRenditionReference` to a rectangle of a packed
+    rendition (the atlas); each atlas is decoded once and every reference is
+    served as a NumPy view over it, without copying.
+
+    Atlases are kept until all their references announced with `plan` have
+    been served, then dropped. Atlases of unplanned references go through a
+    `RenditionCache`, the one of the file when it has one or a private one of
+    `budget` bytes, and are evicted with its other entries. Concurrent first
+    requests for the same atlas may decode it more than once, but only one
+    copy is kept.
+    """
+
+    def __init__(self, car, max_memory=DEFAULT_MAX_MEMORY,
+                 budget=DEFAULT_BUDGET):
+        self.car = car
+        self.max_memory = max_memory
+        self.cache = car.cache if car.cache is not None else \
+            RenditionCache(budget)
+        self.atlases = {}
+        self.references = {}
+        self.decodes = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.atlases)
+
+    def atlas_key(self, reference):
+        """
+        The raw RENDITIONS key of the atlas `reference` points at. Attributes
+        missing from the reference are 0.
+        """
+        identifiers = self.car.key_format.identifiers
+        return struct.pack("<%dH" % len(identifiers),
+                           *[reference.tokens.get(x.identifier_raw, 0)
+                             for x in identifiers])
+
+    def plan(self, renditions):
+        """
+        Announces `renditions` that are about to be served, so atlases are
+        dropped as soon as their last reference among them is.
+        """
+        with self.lock:
+            for rendition in renditions:
+                if rendition.reference is not None:
+                    key = self.atlas_key(rendition.reference)
+                    self.references[key] = self.references.get(key, 0) + 1
+
+    def pixels(self, rendition, max_memory=None):
+        """
+        The pixels of `rendition` as a (height, width, channels) uint8 NumPy
+        array: a view of its atlas for internal links, the atlas itself for a
+        planned atlas, a decode otherwise. See `RenditionDecoder.pixels`;
+        `max_memory` defaults to the one of the cache.
+        """
+        max_memory = max_memory or self.max_memory
+        reference = rendition.reference
+        if reference is None:
+            with self.lock:
+                planned = rendition.key in self.references
+            if planned:
+                return self._atlas(rendition.key, rendition, max_memory,
+                                   rendition)
+
+            return RenditionDecoder(rendition, max_memory).pixels()
+
+        key = self.atlas_key(reference)
+        atlas = self._atlas(key, rendition, max_memory)
+        crop = atlas[reference.y:reference.y + reference.height,
+                     reference.x:reference.x + reference.width]
+        self._served(key)
+        if crop.shape[:2] != (reference.height, reference.width):
+            raise RenditionDecoderError("%s references pixels outside its "
+                                        "atlas" % rendition.name)
+
+        return crop
+
+    def clear(self):
+        with self.lock:
+            self.atlases.clear()
+            self.references.clear()
+
+    def _atlas(self, key, rendition, max_memory, source=None):
+        cache_key = (self.car.identity, "pixels", key)
+        with self.lock:
+            atlas = self.atlases.get(key)
+            planned = key in self.references
+        if atlas is None and not planned:
+            atlas = self.cache.get(cache_key)
+        if atlas is not None:
+            return atlas
+
+        source = source or self.car.rendition_for_key(key, lazy=True)
+        if source is None:
+            raise RenditionDecoderError("Missing atlas for %s" %
+                                        rendition.name)
+
+        atlas = RenditionDecoder(source, max_memory).pixels()
+        with self.lock:
+            self.decodes += 1
+            if planned:
+                return self.atlases.setdefault(key, atlas)
+
+        return self.cache.put(cache_key, atlas, array_size(atlas))
+
+    def _served(self, key):
+        with self.lock:
+            left = self.references.get(key)
+            if left is None:
+                return
+
+            if left > 1:
+                self.references[key] = left - 1
+                return
+
+            del self.references[key]
+            if self.atlases.pop(key, None) is not None:
+                self.evictions += 1
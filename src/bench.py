@@ -0,0 +1,166 @@
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+
+from car import CARFile
+from decoders import RenditionDecoder
+from synthetic import synthesize
+
+
+# (facets, renditions per facet, fanout, payload size)
+DEFAULT_SCALES = [
+    (100, 6, 64, 1024),
+    (1000, 6, 64, 1024),
+    (5000, 12, 64, 4096),
+]
+
+LOOKUPS = 1000
+DECODES = 200
+
+
+def measure(function, repeat):
+    """
+    Best wall clock time of `repeat` runs of `function`, in seconds.
+    """
+    timings = []
+    for _ in xrange(repeat):
+        start = time.time()
+        function()
+        timings.append(time.time() - start)
+
+    return min(timings)
+
+
+def benchmark(path, repeat=3, seed=0):
+    """
+    Times the main operations on the car file at `path`. Returns a dict of
+    metric name -> seconds.
+    """
+    car = CARFile(path)
+    names = car.index.facets.keys()
+    generator = random.Random(seed)
+    lookups = [generator.choice(names) for _ in xrange(LOOKUPS)]
+    decodes = [rendition for _, rendition in
+               zip(xrange(DECODES), car.iter_renditions(lazy=True))]
+
+    def consume(iterable):
+        for _ in iterable:
+            pass
+
+    def lookup():
+        for name in lookups:
+            car.lookup(name, scale=2, lazy=True)
+
+    return {
+        "open": measure(lambda: CARFile(path), repeat),
+        "index": measure(lambda: CARFile(path).index, repeat),
+        "facets": measure(lambda: consume(car.facets), repeat),
+        "renditions": measure(lambda: consume(car.iter_renditions()),
+                              repeat),
+        "renditions_lazy": measure(
+            lambda: consume(car.iter_renditions(lazy=True)), repeat),
+        "lookup": measure(lookup, repeat),
+        "decode": measure(lambda: [RenditionDecoder(rendition).decode()
+                                   for rendition in decodes], repeat),
+    }
+
+
+def revision():
+    try:
+        directory = os.path.dirname(os.path.abspath(__file__))
+        return subprocess.check_output(["git", "rev-parse", "--short",
+                                        "HEAD"], cwd=directory).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(scales=DEFAULT_SCALES, repeat=3, output=None):
+    """
+    Generates a synthetic file per scale, benchmarks it and appends one JSON
+    record per scale to `output` so runs can be compared across commits.
+    """
+    directory = tempfile.mkdtemp(prefix="pycar-bench")
+    records = []
+    try:
+        for facets, renditions, fanout, payload_size in scales:
+            path = os.path.join(directory, "%d-%d.car" % (facets, renditions))
+            synthesize(path, facets, renditions, fanout, payload_size)
+            records.append({
+                "revision": revision(),
+                "time": time.time(),
+                "python": platform.python_version(),
+                "scale": [facets, renditions, fanout, payload_size],
+                "size": os.path.getsize(path),
+                "results": benchmark(path, repeat),
+            })
+    finally:
+        shutil.rmtree(directory)
+
+    if output:
+        with open(output, "a") as stream:
+            for record in records:
+                stream.write(json.dumps(record, sort_keys=True) + "\n")
+
+    return records
+
+
+def compare(output):
+    """
+    Prints the latest results of every scale recorded in `output` next to
+    the previous run of the same scale.
+    """
+    history = {}
+    with open(output) as stream:
+        for line in stream:
+            record = json.loads(line)
+            history.setdefault(tuple(record["scale"]), []).append(record)
+
+    for scale, records in sorted(history.iteritems()):
+        latest = records[-1]
+        previous = records[-2] if len(records) > 1 else None
+        print "Scale %s (%s vs %s)" % \
+            ("x".join(map(str, scale)), latest["revision"],
+             previous and previous["revision"])
+        for metric, value in sorted(latest["results"].iteritems()):
+            line = "  %-16s %10.4fs" % (metric, value)
+            if previous and metric in previous["results"]:
+                before = previous["results"][metric]
+                line += " %10.4fs %+7.1f%%" % \
+                    (before, (value - before) * 100.0 / (before or 1))
+
+            print line
+
+        print ""
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Synthetic CAR benchmarks")
+    parser.add_argument("--output", help="JSON lines file results are "
+                        "appended to", default="bench.jsonl")
+    parser.add_argument("--repeat", help="Runs per measurement", type=int,
+                        default=3)
+    parser.add_argument("--scale", help="facets,renditions,fanout,payload; "
+                        "can be repeated", action="append", dest="scales")
+    parser.add_argument("--compare", help="Only print the comparison of the "
+                        "last two runs", action="store_true")
+    arguments = parser.parse_args()
+
+    if not arguments.compare:
+        scales = DEFAULT_SCALES
+        if arguments.scales:
+            scales = [tuple(int(x) for x in scale.split(","))
+                      for scale in arguments.scales]
+
+        run(scales, arguments.repeat, arguments.output)
+
+    compare(arguments.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,17 @@
+import struct
+import sys
+
+import instrument
+from array import array
+from collections import namedtuple
 from models import Model
 from parse import Parse
 
 
+# An entry of the block index: byte offset of the block and its size.
+BlockEntry = namedtuple("BlockEntry", ("index", "size"))
+
+
 class BOMInvalidTreeType(Exception):
     pass
 
@@ -25,6 +35,72 @@ class BOMBlock(Model):
     ]
 
 
+class BOMBlockTable(object):
+    """
+    The BOM block index as one flat `array('I')` of (offset, size) pairs in
+    native byte order. It is decoded in a single pass over the index region,
+    without a Python object per block; `table[i]` builds the `BlockEntry` of
+    block `i` on demand.
+    """
+
+    def __init__(self, entries):
+        """
+        - parameter entries: `array('I')` of interleaved offsets and sizes.
+        """
+        self.entries = entries
+
+    _count = struct.Struct(">I")
+
+    @classmethod
+    def make(cls, stream):
+        """
+        Decodes a block index (big endian count followed by that many offset
+        and size pairs) from the current position of `stream`.
+        """
+        count, = stream.unpack(BOMBlockTable._count)
+        entries = array("I")
+        entries.fromstring(stream.read(count * 8))
+        if len(entries) != count * 2:
+            raise ValueError("Truncated block index")
+
+        if sys.byteorder == "little":
+            entries.byteswap()
+
+        return cls(entries)
+
+    def __len__(self):
+        return len(self.entries) // 2
+
+    def __getitem__(self, index):
+        entries = self.entries
+        return BlockEntry(entries[index * 2], entries[index * 2 + 1])
+
+    def __iter__(self):
+        entries = self.entries
+        for i in xrange(0, len(entries), 2):
+            yield BlockEntry(entries[i], entries[i + 1])
+
+    def changes(self, other, chunk=4096):
+        """
+        Indexes of the blocks whose offset or size differ in the `other`
+        table, including blocks only present in one of them. Unchanged runs
+        of `chunk` entries are skipped with a single comparison.
+        """
+        a, b = self.entries, other.entries
+        common = min(len(a), len(b))
+        changed = []
+        for start in xrange(0, common, chunk):
+            end = min(start + chunk, common)
+            if a[start:end] == b[start:end]:
+                continue
+
+            changed.extend(i // 2 for i in xrange(start, end, 2)
+                           if a[i] != b[i] or a[i + 1] != b[i + 1])
+
+        changed.extend(xrange(common // 2, max(len(a), len(b)) // 2))
+        return changed
+
+
 class BOMPathIndex(Model):
     fields = [
         ('value_index', Parse.fixed(">I")),
@@ -44,26 +120,100 @@ class BOMPath(Model):
 
 class BOMTree(Model):
     def iterate(self, stream_index):
+        for key, value_index in self.iterate_keys(stream_index):
+            stream, block = stream_index(value_index)
+            yield key, stream.view(block.size)
+
+    def iterate_keys(self, stream_index):
+        """
+        Walks the leaves yielding (key, value block index) pairs without
+        touching the value blocks.
+        """
         if self.magic != "tree" or self.version != 1:
             raise BOMInvalidTreeType("Invalid tree type %s" % self)
 
+        profile = instrument.active
         path = BOMPath.make(stream_index(self.child).stream)
-        if not path.is_leaf:
+        while not path.is_leaf:
             index = path.indexes[0]
             path = BOMPath.make(stream_index(index.value_index).stream)
 
         while path:
+            if profile is not None:
+                profile.leaves += 1
+                profile.entries += len(path.indexes)
+
             for index in path.indexes:
+                stream, block = stream_index(index.key_index)
+                yield stream.read(block.size), index.value_index
+
+            if not path.forward:
+                break
+
+            path = BOMPath.make(stream_index(path.forward).stream)
+
+    def get(self, stream_index, key):
+        """
+        Point lookup of `key`, returns its value or None when missing.
+        """
+        for found, value in self.range(stream_index, key):
+            return value if found == key else None
+
+    def range(self, stream_index, lo=None, hi=None):
+        """
+        Yields the (key, value) pairs with lo <= key < hi. Either bound can be
+        None to leave that side open. Non-leaf keys are used to binary-search
+        the first leaf, so only O(log n) paths are read before the walk along
+        the `forward` chain. Keys are compared as raw bytes.
+        """
+        if self.magic != "tree" or self.version != 1:
+            raise BOMInvalidTreeType("Invalid tree type %s" % self)
+
+        path = BOMPath.make(stream_index(self.child).stream)
+        while not path.is_leaf:
+            # Non-leaf keys bound their children, start one child early so a
+            # key equal to the bound is never skipped.
+            position = 0
+            if lo is not None:
+                position = max(self._bisect(stream_index, path, lo) - 1, 0)
+
+            index = path.indexes[position]
+            path = BOMPath.make(stream_index(index.value_index).stream)
+
+        position = 0 if lo is None else self._bisect(stream_index, path, lo)
+        while path:
+            for index in path.indexes[position:]:
                 stream, block = stream_index(index.key_index)
                 key = stream.read(block.size)
+                if lo is not None and key < lo:
+                    continue
+
+                if hi is not None and key >= hi:
+                    return
+
                 stream, block = stream_index(index.value_index)
-                value = stream.read(block.size)
-                yield key, value
+                yield key, stream.view(block.size)
 
             if not path.forward:
                 break
 
             path = BOMPath.make(stream_index(path.forward).stream)
+            position = 0
+
+    def _bisect(self, stream_index, path, key):
+        """
+        Position of the first index in `path` whose key is not below `key`.
+        """
+        lo, hi = 0, len(path.indexes)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            stream, block = stream_index(path.indexes[mid].key_index)
+            if stream.read(block.size) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return lo
 
     custom = ["name"]
     fields = [
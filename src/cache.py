@@ -0,0 +1,180 @@
+import sys
+import threading
+
+from collections import OrderedDict
+
+from decoders import RenditionDecoder, DEFAULT_MAX_MEMORY
+from models import Model
+from pixels import encode_png
+
+
+DEFAULT_BUDGET = 64 * 1024 * 1024
+
+
+def footprint(model):
+    """
+    Estimated bytes held by a parsed model: the object and its attribute
+    values, following nested models, lists, tuples and dict values. Views
+    over the file mapping only count their own object, dict keys (attribute
+    identifiers shared by the whole file) are not counted.
+    """
+    total = 0
+    seen = set()
+    pending = [model]
+    while pending:
+        value = pending.pop()
+        if id(value) in seen:
+            continue
+
+        seen.add(id(value))
+        total += sys.getsizeof(value)
+        if isinstance(value, Model):
+            pending.extend(x for _, x in value._attributes())
+        elif isinstance(value, (list, tuple)):
+            pending.extend(value)
+        elif isinstance(value, dict):
+            pending.extend(value.itervalues())
+
+    return total
+
+
+def array_size(pixels):
+    """
+    Bytes kept alive by a NumPy array: those of the array it is a view of,
+    if any.
+    """
+    while getattr(pixels.base, "nbytes", None) is not None:
+        pixels = pixels.base
+
+    return pixels.nbytes
+
+
+class RenditionCache(object):
+    """
+    Least recently used cache of parsed `CARRendition` headers and decoded
+    images, shared by any number of car files and threads. Entries are keyed
+    by the file identity (path, size and modification time at open) and the
+    raw rendition key, so a file replaced on disk never hits stale entries.
+    Methods taking a `car` read a single `CARSnapshot` of it, so values are
+    stored under the identity of the blocks they were read from.
+
+    The total size of the entries is kept under `budget` bytes by evicting
+    the least recently used ones. Renditions are accounted by the estimated
+    memory of their parsed objects (see `footprint`; payloads stay in the
+    file mapping), pixel arrays by the bytes they keep alive and images by
+    their length.
+    """
+
+    def __init__(self, budget=DEFAULT_BUDGET):
+        self.budget = budget
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """
+        Returns the value cached for `key`, marking it as recently used, or
+        None.
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size):
+        """
+        Caches `value`, accounted as `size` bytes, evicting the least recently
+        used entries beyond the budget. Values bigger than the whole budget
+        are not cached. Returns `value`.
+        """
+        if size > self.budget:
+            return value
+
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous[1]
+
+            self.entries[key] = (value, size)
+            self.size += size
+            while self.size > self.budget:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= evicted
+                self.evictions += 1
+
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def rendition(self, car, value_index, key, lazy=None):
+        """
+        The rendition of `car` stored on block `value_index`, parsed on the
+        first request only. See `CARFile.rendition_at`.
+        """
+        car = car.snapshot
+        cache_key = (car.identity, "rendition", key)
+        rendition = self.get(cache_key)
+        if rendition is None:
+            rendition = car.rendition_at(value_index, key, lazy)
+            # Decoding needs the info array anyway, parse it before sizing.
+            rendition.info
+            self.put(cache_key, rendition, footprint(rendition))
+
+        return rendition
+
+    def pixels(self, car, rendition, max_memory=DEFAULT_MAX_MEMORY):
+        """
+        The decoded pixels of `rendition`, a rendition of `car`, as returned
+        by `RenditionDecoder.pixels`. Internal links are cropped from
+        `car.atlases` and not cached themselves, their atlas is.
+        """
+        car = car.snapshot
+        if rendition.reference is not None:
+            return car.atlases.pixels(rendition, max_memory)
+
+        cache_key = (car.identity, "pixels", rendition.key)
+        pixels = self.get(cache_key)
+        if pixels is None:
+            pixels = RenditionDecoder(rendition, max_memory).pixels()
+            self.put(cache_key, pixels, array_size(pixels))
+
+        return pixels
+
+    def image(self, car, value_index, key, max_memory=DEFAULT_MAX_MEMORY):
+        """
+        The image file contents for the rendition of `car` stored on block
+        `value_index`, as returned by `RenditionDecoder.decode`; internal
+        links are cropped from `car.atlases`. Hits skip both reading and
+        decompressing the payload.
+        """
+        car = car.snapshot
+        cache_key = (car.identity, "image", key)
+        image = self.get(cache_key)
+        if image is None:
+            rendition = self.rendition(car, value_index, key, lazy=True)
+            if rendition.reference is not None:
+                image = encode_png(self.pixels(car, rendition, max_memory))
+            else:
+                image = RenditionDecoder(rendition, max_memory).decode()
+            self.put(cache_key, image, len(image))
+
+        return image
+
+    def stats(self):
+        return {"entries": len(self.entries), "size": self.size,
+                "budget": self.budget, "hits": self.hits,
+                "misses": self.misses, "evictions": self.evictions}
@@ -1,13 +1,25 @@
+import copy
+import hashlib
+import mmap
 import os
 import struct
 import sys
+import threading
 
+import instrument
+from array import array
 from itertools import izip
 from collections import namedtuple
 from models import CARHeader, CARKeyFormat, CARKeyFormatIdentifier, \
-                   CARRendition, CARFacet
-from bom_models import BOMHeader, BOMBlock, BOMExtendedMetadata, BOMTree, \
-                       BOMPath
+                   CARRendition, CARFacet, CARNamedIdentifier, CARColor, \
+                   CARBitmapKey
+from bom_models import BOMHeader, BOMBlockTable, BOMExtendedMetadata, \
+                       BOMTree, BOMPath
+from atlas import AtlasCache
+from decoders import RenditionDecoder, DEFAULT_MAX_MEMORY
+from index import CARIndex, RenditionTable, key_filter
+from stream import BufferStream
+from utils import locked_cached_property
 
 
 BLOCK_CARHEADER = 'CARHEADER'
@@ -26,6 +38,13 @@ BLOCK_FONT_SIZES = "FONTSIZES"
 BLOCK_GLYPHS = "GLYPHS"
 BLOCK_BEZELS = "BEZELS"
 
+# Rendition attribute connecting renditions to the facet they belong to.
+IDENTIFIER_ATTRIBUTE = 17
+
+# Trees indexed on demand into lookup tables (see `CARFile.colors`...).
+LOOKUP_TABLES = [BLOCK_BITMAP_KEYS, BLOCK_ELEMENT_INFO, BLOCK_PART_INFO,
+                 BLOCK_COLORS, BLOCK_EXTERNAL_KEYS]
+
 
 class BOMInvalidFile(Exception):
     pass
@@ -34,30 +53,45 @@ class BOMInvalidFile(Exception):
 StreamBlock = namedtuple("StreamBlock", ("stream", "block"))
 
 
-class CARFile(object):
+class CARSnapshot(object):
     """
-    Compiled Asset Archive format (car)
-
-    A car file is a specialized BOM file. It contains a bunch of named assets
-    called "facets" and variants of them (renditions). New content types are
-    added by blocks that are indexed on the table of contents at the end of
-    the file. This class provides abstraction for the supported types
-    (facets, renditions, etc) but you can also query unsupported types using
-    `_stream_named`.
+    The parsed state of a car file at one point in time: its data (memory
+    mapped, or read into memory with `mapped` unset), block table, ToC and
+    everything built from them (models, index, lookup tables, atlases). A
+    snapshot never sees a file replaced afterwards, nor, when not mapped, one
+    rewritten in place, so a value index found in its `index` always resolves
+    against the blocks it was read from. `CARFile.refresh` builds a new one
+    instead.
+
+    Every block read goes through its own cursor over the data and never
+    moves shared state, so generators can be interleaved and one snapshot
+    can serve lookups from many threads; the `index` and `rendition_table`
+    are built once, by the first thread asking for them.
     """
 
-    def __init__(self, path):
+    def __init__(self, path, lazy=False, sidecar=None, cache=None,
+                 mapped=True):
         """
-        Parses a car file on a given file path. Note that this is not
-        optimized and almost no parsing is lazy.
-
-        - parameter path: The full path where the car file is located.
+        Parses a car file on a given file path, see `CARFile`.
         """
-        self.stream = open(path, "rb")
         self.path = path
-        self.size = os.stat(path).st_size
+        self.lazy = lazy
+        self.sidecar = sidecar
+        self.cache = cache
+        self.mapped = mapped
+        self._lock = threading.RLock()
+        # Named blocks parsed so far (header, key format...), and the blocks
+        # each indexed tree was built from; both carry over to the snapshot
+        # `CARFile.refresh` builds when still valid.
+        self._models = {}
+        self._tree_blocks = {}
+        self._open()
         self._parse(self.stream)
 
+    @property
+    def snapshot(self):
+        return self
+
     # - Public methods
 
     @property
@@ -66,15 +100,14 @@ class CARFile(object):
         Information about the file contents, a version marker, and creator
         string. This is stored as a named structure indexed on the ToC.
         """
-        return CARHeader.make(self._stream_named(BLOCK_CARHEADER).stream)
+        return self._named_model(BLOCK_CARHEADER, CARHeader)
 
     @property
     def metadata(self):
         """
         Extra information about the file content (optimized flag, gamut, etc)
         """
-        stream_block = self._stream_named(BLOCK_EXTENDED_METADATA)
-        return BOMExtendedMetadata.make(stream_block.stream)
+        return self._named_model(BLOCK_EXTENDED_METADATA, BOMExtendedMetadata)
 
     @property
     def key_format(self):
@@ -82,7 +115,7 @@ class CARFile(object):
         Returns an array of supported key_format(s). Note that order is
         important since some blocks return an array values with the same order.
         """
-        return CARKeyFormat.make(self._stream_named(BLOCK_KEY_FORMAT).stream)
+        return self._named_model(BLOCK_KEY_FORMAT, CARKeyFormat)
 
     @property
     def renditions(self):
@@ -91,13 +124,162 @@ class CARFile(object):
         order of attribute identifiers from `key_format`. Each rendition key
         is unique and has an identifier connecting it to the facet it beongs to
         """
+        return self.iter_renditions()
+
+    def iter_renditions(self, lazy=None, where=None):
+        """
+        Generator over all renditions, see `renditions`.
+
+        - parameter lazy:  Only decode the fixed rendition header upfront, the
+                           `info` array and `content` payload are parsed on
+                           first access. Defaults to the file `lazy` flag.
+        - parameter where: Only yield the renditions whose key matches, given
+                           as a dict of attribute name -> value or values
+                           (e.g. `{"scale": 2, "idiom": [0, 1]}`) or as a
+                           callable taking the attribute name -> value dict.
+                           Keys are tested before their value is read, so a
+                           skipped rendition only costs its key bytes.
+        """
+        lazy = self.lazy if lazy is None else lazy
         tree = BOMTree.make(self._stream_named(BLOCK_RENDITIONS).stream)
         identifiers = self.key_format.identifiers
-        for key, value in tree.iterate(self._stream_index):
-            attrs_values = [struct.unpack("<H", key[i:i + 2])[0]
-                            for i in xrange(0, len(key), 2)]
-            attributes = dict(izip(identifiers, attrs_values))
-            yield CARRendition.make_from_buffer(value, attributes=attributes)
+        if where is None:
+            for key, value in tree.iterate(self._stream_index):
+                yield self._make_rendition(identifiers, key, value, lazy)
+
+            return
+
+        matches = key_filter(identifiers, where)
+        layout = struct.Struct("<%dH" % len(identifiers))
+        for key, value_index in tree.iterate_keys(self._stream_index):
+            if matches(layout.unpack(key)):
+                stream, block = self._stream_index(value_index)
+                yield self._make_rendition(identifiers, key,
+                                           stream.view(block.size), lazy)
+
+    def rendition_at(self, value_index, key, lazy=None):
+        """
+        Parses the rendition whose value is stored on block `value_index`,
+        e.g. as referenced by `index`.
+
+        - parameter key:  The raw rendition key.
+        - parameter lazy: See `iter_renditions`.
+        """
+        lazy = self.lazy if lazy is None else lazy
+        stream, block = self._stream_index(value_index)
+        return self._make_rendition(self.key_format.identifiers, key,
+                                    stream.view(block.size), lazy)
+
+    def rendition_for_key(self, key, lazy=None):
+        """
+        Finds a single rendition by binary-searching the RENDITIONS tree,
+        without building the file index. Returns None when missing.
+
+        - parameter key:  Raw key bytes or the sequence of attribute values,
+                          ordered as `key_format.identifiers`.
+        - parameter lazy: See `iter_renditions`.
+        """
+        lazy = self.lazy if lazy is None else lazy
+        if not isinstance(key, str):
+            key = struct.pack("<%dH" % len(key), *key)
+
+        tree = BOMTree.make(self._stream_named(BLOCK_RENDITIONS).stream)
+        value = tree.get(self._stream_index, key)
+        if value is None:
+            return None
+
+        return self._make_rendition(self.key_format.identifiers, key, value,
+                                    lazy)
+
+    @locked_cached_property
+    def index(self):
+        """
+        Facet name -> identifier -> rendition keys -> value block index,
+        built once per file from the tree keys only (see `CARIndex`).
+        """
+        index = CARIndex(self.key_format.identifiers, self.identifier_index)
+        self._index_facets(index)
+        self._index_renditions(index)
+        return index
+
+    @locked_cached_property
+    def atlases(self):
+        """
+        The `AtlasCache` internal link renditions are cropped from.
+        """
+        return AtlasCache(self)
+
+    def pixels(self, rendition, max_memory=DEFAULT_MAX_MEMORY):
+        """
+        The decoded pixels of `rendition`, a rendition of this file, see
+        `RenditionDecoder.pixels`. Internal links are cropped from `atlases`
+        and arrays are served from `cache` when the file has one.
+        """
+        if self.cache is not None:
+            return self.cache.pixels(self, rendition, max_memory)
+
+        if rendition.reference is not None:
+            return self.atlases.pixels(rendition, max_memory)
+
+        return RenditionDecoder(rendition, max_memory).pixels()
+
+    @locked_cached_property
+    def rendition_table(self):
+        """
+        All rendition keys as a columnar NumPy table (see `RenditionTable`),
+        built from the tree keys only.
+        """
+        tree = BOMTree.make(self._stream_named(BLOCK_RENDITIONS).stream)
+        keys = []
+        value_indexes = array("I")
+        for key, value_index in tree.iterate_keys(self._stream_index):
+            keys.append(key)
+            value_indexes.append(value_index)
+
+        columns = [x.identifier for x in self.key_format.identifiers]
+        return RenditionTable(self, columns, "".join(keys), value_indexes)
+
+    def lookup(self, name, lazy=None, **attributes):
+        """
+        Returns the renditions of the facet `name` matching the given
+        attribute values (e.g. `scale=2, idiom=1, appearance=0`). Only the
+        matching rendition values are read, and only once when the file has a
+        `cache`.
+
+        - parameter name: The facet name.
+        - parameter lazy: See `iter_renditions`.
+        """
+        lazy = self.lazy if lazy is None else lazy
+        index = self.index
+        renditions = []
+        for values, value_index in index.find(name, **attributes):
+            key = index.key_layout.pack(*values)
+            if self.cache is not None:
+                renditions.append(self.cache.rendition(self, value_index, key,
+                                                       lazy))
+                continue
+
+            stream, block = self._stream_index(value_index)
+            renditions.append(self._make_rendition(
+                index.identifiers, key, stream.view(block.size), lazy))
+
+        return renditions
+
+    def facet_identifier(self, name):
+        """
+        The identifier attribute of the facet `name`, connecting it to its
+        renditions, or None when missing. Binary-searches the FACETKEYS tree
+        unless the index is already built.
+        """
+        if "index" in self.__dict__:
+            return self.index.facets.get(name)
+
+        tree = BOMTree.make(self._stream_named(BLOCK_FACET_KEYS).stream)
+        value = tree.get(self._stream_index, name)
+        if value is None:
+            return None
+
+        return self._facet_identifier(CARFacet.make_from_buffer(value))
 
     @property
     def facets(self):
@@ -110,11 +292,51 @@ class CARFile(object):
         identifiers = dict((x.identifier_raw, x)
                            for x in self.key_format.identifiers)
         for key, value in tree.iterate(self._stream_index):
-            facet = CARFacet.make_from_buffer(value, name=key)
+            facet = CARFacet.make_from_buffer(value, name=key, car=self)
             facet.attributes = dict((identifiers[x.identifier], x.value)
                                     for x in facet.attributes_raw)
             yield facet
 
+    @property
+    def element_names(self):
+        """
+        Element identifier -> name, from the ELEMENT_INFO tree.
+        """
+        return self._lookup_table(BLOCK_ELEMENT_INFO,
+                                  self._names_by_identifier)
+
+    @property
+    def part_names(self):
+        """
+        Part identifier -> name, from the PART_INFO tree.
+        """
+        return self._lookup_table(BLOCK_PART_INFO, self._names_by_identifier)
+
+    @property
+    def colors(self):
+        """
+        Color name -> (red, green, blue, alpha) components, from the COLORS
+        tree.
+        """
+        return self._lookup_table(BLOCK_COLORS, self._colors)
+
+    @property
+    def bitmap_keys(self):
+        """
+        Facet identifier -> attribute identifier -> value of its bitmap key,
+        from the BITMAPKEYS tree.
+        """
+        return self._lookup_table(BLOCK_BITMAP_KEYS, self._bitmap_keys)
+
+    @property
+    def external_keys(self):
+        """
+        Rendition key attribute values (ordered as `key_format.identifiers`)
+        -> raw value of the renditions stored outside the file, from the
+        EXTERNAL_KEYS tree.
+        """
+        return self._lookup_table(BLOCK_EXTERNAL_KEYS, self._external_keys)
+
     def dump(self):
         """
         Pretty print version of the CAR file containing the general information
@@ -133,10 +355,223 @@ class CARFile(object):
 
     # - Private helpers
 
+    def _open(self):
+        with open(self.path, "rb") as stream:
+            stat = os.fstat(stream.fileno())
+            if not stat.st_size:
+                raise BOMInvalidFile("Empty file %s" % self.path)
+
+            if self.mapped:
+                data = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                data = stream.read(stat.st_size)
+
+        # Views handed out before a `refresh` keep the previous data alive.
+        self.data = data
+        self.size = len(data)
+        # What the file is, for caches outliving this instance.
+        self.identity = (os.path.abspath(self.path), stat.st_size,
+                         stat.st_mtime)
+        self.stream = BufferStream(self.data)
+
+    def _digest_named(self):
+        """
+        Name -> digest of the bytes of every block on the ToC, for `refresh`
+        to tell which ones changed (see `_recording`).
+        """
+        return dict((name, self._digest([index]))
+                    for name, index in self.table.iteritems())
+
+    def _named_model(self, name, model):
+        parsed = self._models.get(name)
+        if parsed is None:
+            parsed = model.make(self._stream_named(name).stream)
+            self._models[name] = parsed
+
+        return parsed
+
+    @staticmethod
+    def _facet_identifier(facet):
+        for attribute in facet.attributes_raw:
+            if attribute.identifier == IDENTIFIER_ATTRIBUTE:
+                return attribute.value
+
+    def _recording(self, visited, digest):
+        """
+        A `_stream_index` appending every block index it reads to `visited`
+        and its bytes to the `hashlib` `digest`. The mapping follows the file
+        when it is written in place, so `refresh` compares digests rather
+        than the bytes themselves.
+        """
+        def stream_index(index):
+            visited.append(index)
+            streamed = self._stream_index(index)
+            block = streamed.block
+            digest.update(buffer(self.data, block.index, block.size))
+            return streamed
+
+        return stream_index
+
+    def _index_facets(self, index):
+        visited = array("I")
+        digest = hashlib.sha1()
+        stream_index = self._recording(visited, digest)
+        tree = BOMTree.make(stream_index(self.table[BLOCK_FACET_KEYS]).stream)
+        for key, value in tree.iterate(stream_index):
+            identifier = self._facet_identifier(
+                CARFacet.make_from_buffer(value, name=key))
+            if identifier is not None:
+                index.add_facet(key, identifier)
+
+        self._tree_blocks[BLOCK_FACET_KEYS] = (visited, digest.digest())
+
+    def _index_renditions(self, index):
+        visited = array("I")
+        digest = hashlib.sha1()
+        stream_index = self._recording(visited, digest)
+        tree = BOMTree.make(stream_index(self.table[BLOCK_RENDITIONS]).stream)
+        for key, value_index in tree.iterate_keys(stream_index):
+            index.add_rendition(key, value_index)
+
+        self._tree_blocks[BLOCK_RENDITIONS] = (visited, digest.digest())
+
+    def _lookup_table(self, name, build):
+        """
+        The dict built by `build` from the (key, value) pairs of the tree
+        `name`, empty when the file has no such block. Tables are built on
+        first access and kept until `refresh` finds their blocks changed.
+        """
+        with self._lock:
+            table = self._models.get(name)
+            if table is not None:
+                return table
+
+            table = {}
+            if name in self.table:
+                visited = array("I")
+                digest = hashlib.sha1()
+                stream_index = self._recording(visited, digest)
+                tree = BOMTree.make(stream_index(self.table[name]).stream)
+                table = build(tree.iterate(stream_index))
+                self._tree_blocks[name] = (visited, digest.digest())
+            else:
+                self._tree_blocks.pop(name, None)
+
+            self._models[name] = table
+            return table
+
+    @staticmethod
+    def _names_by_identifier(items):
+        return dict((CARNamedIdentifier.make_from_buffer(value).identifier,
+                     key.rstrip("\x00")) for key, value in items)
+
+    @staticmethod
+    def _colors(items):
+        return dict((key.rstrip("\x00"),
+                     CARColor.make_from_buffer(value).components)
+                    for key, value in items)
+
+    @staticmethod
+    def _bitmap_keys(items):
+        table = {}
+        for key, value in items:
+            identifier, = struct.unpack_from("<I", key)
+            bitmap = CARBitmapKey.make_from_buffer(value)
+            table[identifier] = dict((x.identifier, x.value)
+                                     for x in bitmap.attributes_raw)
+
+        return table
+
+    @staticmethod
+    def _external_keys(items):
+        return dict((struct.unpack("<%dH" % (len(key) // 2), key), value)
+                    for key, value in items)
+
+    def _digest(self, indexes):
+        digest = hashlib.sha1()
+        for index in indexes:
+            block = self.blocks[index]
+            digest.update(buffer(self.data, block.index, block.size))
+
+        return digest.digest()
+
+    def _tree_changed(self, name, fresh, moved):
+        """
+        Whether the bytes of the blocks the tree `name` was indexed from
+        differ in the `fresh` snapshot. Without recorded blocks, as for an
+        index restored from the sidecar, a built index or rendition table is
+        always stale; otherwise it is decided from the sorted list of `moved`
+        block indexes.
+        """
+        recorded = self._tree_blocks.get(name)
+        if recorded is None:
+            return bool(moved) or "index" in self.__dict__ or \
+                "rendition_table" in self.__dict__
+
+        visited, digest = recorded
+        if visited and max(visited) >= len(fresh.blocks):
+            return True
+
+        return fresh._digest(visited) != digest
+
+    def _reindex(self, stale):
+        """
+        Rebuilds the parts of the index (and rendition table) coming from the
+        `stale` trees, when they were already built.
+        """
+        current = self.__dict__.get("index")
+        if stale and current is not None:
+            index = CARIndex(self.key_format.identifiers,
+                             self.identifier_index)
+            if BLOCK_FACET_KEYS in stale:
+                self._index_facets(index)
+            else:
+                index.facets = current.facets
+
+            if BLOCK_RENDITIONS in stale:
+                self._index_renditions(index)
+            else:
+                index.renditions = current.renditions
+
+            self.index = index
+
+        table = self.__dict__.get("rendition_table")
+        if table is None:
+            return
+
+        if BLOCK_RENDITIONS in stale:
+            del self.rendition_table
+            # Accessing the property builds the table again.
+            getattr(self, "rendition_table")
+        elif table.car is not self:
+            # Same keys, but renditions are read from this snapshot.
+            table = copy.copy(table)
+            table.car = self
+            self.rendition_table = table
+
+    def _make_rendition(self, identifiers, key, value, lazy):
+        values = struct.unpack("<%dH" % (len(key) // 2), key)
+        attributes = dict(izip(identifiers, values))
+        return CARRendition.make_from_buffer(value, lazy=lazy, key=key,
+                                             attributes=attributes)
+
     def _stream_index(self, index):
         block = self.blocks[index]
-        self.stream.seek(block.index, 0)
-        return StreamBlock(self.stream, block)
+        if instrument.active is not None:
+            instrument.active.read_block(block)
+
+        return StreamBlock(BufferStream(self.data, block.index), block)
+
+    def _tree_at(self, index):
+        """
+        The BOMTree stored on block `index`, or None for any other content.
+        """
+        stream, block = self._stream_index(index)
+        if block.size != BOMTree.metadata_size or \
+                self.data[block.index:block.index + 4] != "tree":
+            return None
+
+        return BOMTree.make(stream)
 
     def _stream_named(self, name):
         if name not in self.table:
@@ -144,11 +579,9 @@ class CARFile(object):
 
         return StreamBlock(*self._stream_index(self.table[name]))
 
-    def _parse(self, stream):
+    def _parse_layout(self, stream):
         fheader = self._parse_header(stream)
         self.file_header = fheader
-        self.table = self._parse_table(stream)
-        self.blocks = self._parse_blocks(stream)
 
         if fheader.magic != "BOMStore":
             raise BOMInvalidFile("Invalid magic header %s" % fheader.magic)
@@ -159,15 +592,52 @@ class CARFile(object):
         if fheader.table_offset + fheader.table_size > self.size:
             raise BOMInvalidFile("Table is bigger than file")
 
+    def _check_header(self):
         header = self.header
         if header.magic != "RATC" or header.storage_version < 8:
             raise BOMInvalidFile("Invalid CAR file")
 
         # The index into the attribute list for the identifer for the matching
         # facet.
-        attr = CARKeyFormatIdentifier(identifier_raw=17)
+        attr = CARKeyFormatIdentifier(identifier_raw=IDENTIFIER_ATTRIBUTE)
         self.identifier_index = self.key_format.identifiers.index(attr)
 
+    def _parse(self, stream):
+        self._parse_layout(stream)
+        cached = self.sidecar.load(self) if self.sidecar else None
+        if cached:
+            self.table = cached.table
+            self.blocks = BOMBlockTable(cached.blocks)
+        else:
+            self.table = self._parse_table(stream)
+            self.blocks = self._parse_blocks(stream)
+
+        header = self.header
+        if cached and (header.uuid, header.associated_checksum) != \
+                (cached.uuid, cached.checksum):
+            cached = None
+            self._models.clear()
+            self.table = self._parse_table(stream)
+            self.blocks = self._parse_blocks(stream)
+
+        self._check_header()
+        self._named_digests = self._digest_named()
+        if cached:
+            self.index = self._restore_index(cached)
+        elif self.sidecar:
+            self.sidecar.save(self)
+
+    def _restore_index(self, cached):
+        index = CARIndex(self.key_format.identifiers, self.identifier_index)
+        index.facets.update(cached.facets)
+        width = len(index.identifiers)
+        keys = cached.keys
+        for i, value_index in enumerate(cached.value_indexes):
+            index.add_values(tuple(keys[i * width:(i + 1) * width]),
+                             value_index)
+
+        return index
+
     def _parse_header(self, stream):
         return BOMHeader.make(stream)
 
@@ -184,5 +654,128 @@ class CARFile(object):
 
     def _parse_blocks(self, stream):
         stream.seek(self.file_header.index_offset, 0)
-        count, = struct.unpack(">I", stream.read(4))
-        return [BOMBlock.make(stream) for i in xrange(count)]
+        try:
+            return BOMBlockTable.make(stream)
+        except (ValueError, struct.error) as error:
+            raise BOMInvalidFile("Invalid block index: %s" % error)
+
+
+class CARFile(object):
+    """
+    Compiled Asset Archive format (car)
+
+    A car file is a specialized BOM file. It contains a bunch of named assets
+    called "facets" and variants of them (renditions). New content types are
+    added by blocks that are indexed on the table of contents at the end of
+    the file. This class provides abstraction for the supported types
+    (facets, renditions, etc) but you can also query unsupported types using
+    `_stream_named`.
+
+    An open `CARFile` is a handle on the `CARSnapshot` of its latest
+    `refresh`: attributes and methods (`header`, `index`, `lookup`...) are
+    those of `snapshot`, each call reading the current one. Operations
+    spanning several calls, e.g. finding a value index and then reading it,
+    should hold a single `snapshot` throughout.
+    """
+
+    def __init__(self, path, lazy=False, sidecar=None, cache=None,
+                 mapped=True):
+        """
+        Parses a car file on a given file path. The file is memory mapped and
+        blocks are handed out as zero-copy views over the mapping, so payloads
+        are only copied when a caller asks for their bytes.
+
+        - parameter path: The full path where the car file is located.
+        - parameter lazy: When set renditions only decode their fixed header
+                          upfront; `info` and `content` are parsed on access.
+        - parameter sidecar: Optional `CARSidecar` used to load the block
+                             table, ToC and key index from a previous open,
+                             and to store them when missing or stale.
+        - parameter cache: Optional `RenditionCache` lookups are served from.
+        - parameter mapped: When unset the file is read into memory instead of
+                            mapped, so each snapshot owns its bytes and keeps
+                            working when the file is rewritten in place, even
+                            shorter; see `refresh`.
+        """
+        self._lock = threading.RLock()
+        self.snapshot = CARSnapshot(path, lazy, sidecar, cache, mapped)
+
+    def __getattr__(self, name):
+        # Only reached for attributes missing on the handle itself.
+        if name == "snapshot":
+            raise AttributeError(name)
+
+        return getattr(self.snapshot, name)
+
+    def refresh(self):
+        """
+        Picks up changes of the file on disk since it was opened or last
+        refreshed, without reopening it. The block table and ToC are compared
+        against the previous ones: named blocks are re-parsed only if their
+        bytes changed, and the facet and rendition indexes are only rebuilt
+        when a block they were built from (tree paths, keys, facet values)
+        changed. Lookup tables (`colors`, `element_names`...) are dropped on
+        the same condition and rebuilt on next access. Bytes are compared
+        through digests taken when the blocks were first read, as a file
+        written in place changes the previous mapping too; rendition values
+        are never hashed, so the cost follows the size of the indexes rather
+        than of the file.
+
+        The new `CARSnapshot` replaces `snapshot` in a single assignment, so
+        an operation holding the previous one keeps reading it consistently.
+        A mapped file must be replaced by renaming a new one over it: reading
+        a previous mapping of a file truncated in place kills the process
+        with SIGBUS. Open files watched for in-place writes with `mapped`
+        unset.
+
+        Returns the sorted names of the ToC entries that changed, empty when
+        the file is unchanged.
+        """
+        with self._lock:
+            current = self.snapshot
+            stat = os.stat(current.path)
+            if (os.path.abspath(current.path), stat.st_size, stat.st_mtime) \
+                    == current.identity:
+                return []
+
+            fresh = copy.copy(current)
+            fresh._lock = threading.RLock()
+            fresh.__dict__.pop("atlases", None)
+            fresh._open()
+            fresh._parse_layout(fresh.stream)
+            fresh.table = fresh._parse_table(fresh.stream)
+            fresh.blocks = fresh._parse_blocks(fresh.stream)
+            fresh._named_digests = fresh._digest_named()
+
+            changed = set(current.table) ^ set(fresh.table)
+            for name in set(current.table) & set(fresh.table):
+                if current._named_digests[name] != fresh._named_digests[name]:
+                    changed.add(name)
+
+            moved = current.blocks.changes(fresh.blocks)
+            changed.update(name for name in LOOKUP_TABLES
+                           if name in current._tree_blocks and
+                           current._tree_changed(name, fresh, moved))
+
+            fresh._models = dict((name, model) for name, model in
+                                 current._models.iteritems()
+                                 if name not in changed)
+            fresh._check_header()
+
+            trees = [BLOCK_FACET_KEYS, BLOCK_RENDITIONS]
+            if BLOCK_KEY_FORMAT in changed:
+                stale = trees
+            else:
+                stale = [name for name in trees if name in changed or
+                         current._tree_changed(name, fresh, moved)]
+
+            changed.update(stale)
+            fresh._tree_blocks = dict((name, recorded) for name, recorded in
+                                      current._tree_blocks.iteritems()
+                                      if name not in changed)
+            fresh._reindex(stale)
+            self.snapshot = fresh
+            if fresh.sidecar:
+                fresh.sidecar.save(fresh)
+
+            return sorted(changed)
@@ -0,0 +1,162 @@
+import pixels as vectorised
+
+from decoders import RenditionDecoder, DEFAULT_MAX_MEMORY
+
+
+class CompositeError(Exception):
+    pass
+
+
+TILE = "tile"
+SCALE = "scale"
+
+# layout -> ((horizontal mode, sliced), (vertical mode, sliced)). A sliced
+# axis keeps its caps at their size and tiles or scales the center slice; an
+# unsliced one resamples the whole axis, which is also how "uniform" axes are
+# rendered.
+LAYOUTS = {
+    11: ((TILE, False), (TILE, False)),
+    12: ((SCALE, False), (SCALE, False)),
+    20: ((TILE, True), (SCALE, False)),
+    21: ((SCALE, True), (SCALE, False)),
+    22: ((SCALE, False), (SCALE, False)),
+    23: ((SCALE, False), (TILE, True)),
+    24: ((SCALE, False), (SCALE, True)),
+    25: ((SCALE, False), (SCALE, False)),
+    30: ((TILE, True), (TILE, True)),
+    31: ((SCALE, True), (SCALE, True)),
+    32: ((SCALE, False), (SCALE, True)),
+    33: ((SCALE, True), (SCALE, False)),
+    34: ((SCALE, True), (SCALE, True)),
+}
+
+# Layouts whose center slice is left transparent.
+EDGES_ONLY = 34
+
+# layout -> slices expected in the rendition info
+SLICE_COUNTS = {20: 3, 21: 3, 22: 3, 23: 3, 24: 3, 25: 3}
+
+
+def _resample(start, length, target):
+    # Nearest neighbour indexes of `target` samples over [start, start+length).
+    numpy = vectorised.numpy
+    if not target:
+        return numpy.arange(0)
+
+    return start + (numpy.arange(target) * 2 + 1) * length // (target * 2)
+
+
+def axis_map(length, lo, hi, target, mode=SCALE):
+    """
+    Returns the source index of each of the `target` pixels along an axis of
+    `length` pixels whose first `lo` and last `hi` pixels are caps. Caps are
+    copied as is, the center is tiled or scaled to fill the rest. Targets
+    smaller than both caps shrink the caps proportionally.
+    """
+    numpy = vectorised.numpy
+    if lo + hi > length:
+        raise CompositeError("Caps of %d and %d pixels don't fit in %d" %
+                             (lo, hi, length))
+
+    if target <= lo + hi:
+        head = lo * target // (lo + hi) if lo + hi else 0
+        return numpy.concatenate((_resample(0, lo, head),
+                                  _resample(length - hi, hi, target - head)))
+
+    center = length - lo - hi
+    middle = target - lo - hi
+    if center == 0:
+        # No center slice: stretch the pixel before the end cap.
+        fill = numpy.repeat(max(lo - 1, 0), middle)
+    elif mode == TILE:
+        fill = lo + numpy.arange(middle) % center
+    else:
+        fill = _resample(lo, center, middle)
+
+    return numpy.concatenate((numpy.arange(lo), fill,
+                              numpy.arange(length - hi, length)))
+
+
+def insets(rendition):
+    """
+    Returns the (left, right, top, bottom) cap sizes in pixels, read from the
+    `CARRenditionSlice` rectangles: three slices side by side or stacked for
+    three-part layouts, nine in rows from the top left for nine-part ones.
+    """
+    slices = rendition.slices
+    layout = rendition.layout_raw
+    expected = SLICE_COUNTS.get(layout, 9 if layout >= 30 else 1)
+    if len(slices) < expected:
+        raise CompositeError("%s (%s) has %d slices, expected %d" %
+                             (rendition.name, rendition.layout, len(slices),
+                              expected))
+
+    if expected == 1:
+        return 0, 0, 0, 0
+
+    if expected == 3 and layout < 23:
+        return slices[0].width, slices[2].width, 0, 0
+
+    if expected == 3:
+        return 0, 0, slices[0].height, slices[2].height
+
+    return slices[0].width, slices[2].width, slices[0].height, \
+        slices[6].height
+
+
+def composite(rendition, sizes, max_memory=DEFAULT_MAX_MEMORY, car=None):
+    """
+    Renders a resizable rendition at each (width, height) of `sizes`, in
+    pixels, following its layout: caps keep their size, center slices are
+    tiled or scaled with nearest neighbour sampling. Returns a list of
+    (height, width, channels) uint8 NumPy arrays, in the order of `sizes`.
+
+    The rendition is decoded once, or taken from `car.pixels` when the
+    `CARFile` it belongs to is given. Every output is a single gather of the
+    source through per axis index maps, which are shared by sizes with the
+    same width or height. Requires NumPy.
+    """
+    if rendition.layout_raw not in LAYOUTS:
+        raise CompositeError("%s (%s) is not resizable" %
+                             (rendition.name, rendition.layout))
+
+    if car is not None:
+        source = car.pixels(rendition, max_memory)
+    else:
+        source = RenditionDecoder(rendition, max_memory).pixels()
+    height, width = source.shape[:2]
+    (horizontal, sliced_x), (vertical, sliced_y) = \
+        LAYOUTS[rendition.layout_raw]
+    left = right = top = bottom = 0
+    if sliced_x or sliced_y:
+        left, right, top, bottom = insets(rendition)
+    if not sliced_x:
+        left = right = 0
+    if not sliced_y:
+        top = bottom = 0
+
+    columns = {}
+    rows = {}
+    images = []
+    for target_width, target_height in sizes:
+        if target_width <= 0 or target_height <= 0:
+            raise CompositeError("Invalid size %dx%d" %
+                                 (target_width, target_height))
+
+        if target_width not in columns:
+            columns[target_width] = axis_map(width, left, right,
+                                             target_width, horizontal)
+        if target_height not in rows:
+            rows[target_height] = axis_map(height, top, bottom,
+                                           target_height, vertical)
+
+        image = source[rows[target_height][:, None],
+                       columns[target_width][None, :]]
+        if rendition.layout_raw == EDGES_ONLY and \
+                target_width > left + right and target_height > top + bottom:
+            image[top:target_height - bottom, left:target_width - right] = 0
+
+        images.append(image)
+
+    return images
+
@@ -1,20 +1,303 @@
+import cStringIO as StringIO
+import hashlib
+import os
+import re
+import zlib
+
+import pixels as vectorised
+
+from image import PNGWriter, PNG_COLOR_GRAY_ALPHA, PNG_COLOR_RGBA
+from models import CARRenditionBytesPerRow
+
+
 class RenditionDecoderError(Exception):
     pass
 
 
+# Upper bound for the decompressed and converted rows held at once.
+DEFAULT_MAX_MEMORY = 16 * 1024 * 1024
+
+# Compressed bytes fed to the decompressor at a time.
+INPUT_CHUNK_SIZE = 64 * 1024
+
+
+# Payloads that already are files in a well known format, written as is.
+PASSTHROUGH_FORMATS = {
+    "JPEG": "jpg",
+    "HEIF": "heic",
+    "PDF": "pdf",
+    "DATA": "data",
+}
+
+
+def unpremultiply(pixels, alpha_offset, stride):
+    """
+    Undoes alpha premultiplication in place. `pixels` is a bytearray where
+    each pixel takes `stride` bytes and the alpha byte is at `alpha_offset`,
+    preceded by the color channels.
+    """
+    for i in xrange(alpha_offset, len(pixels), stride):
+        alpha = pixels[i]
+        if alpha == 0 or alpha == 255:
+            continue
+
+        for j in xrange(i - alpha_offset, i):
+            pixels[j] = min(255, (pixels[j] * 255 + alpha // 2) // alpha)
+
+
+def convert_argb(row, width):
+    # Little endian ARGB, i.e. premultiplied BGRA in memory.
+    source = bytearray(row[:width * 4])
+    pixels = bytearray(len(source))
+    pixels[0::4] = source[2::4]
+    pixels[1::4] = source[1::4]
+    pixels[2::4] = source[0::4]
+    pixels[3::4] = source[3::4]
+    unpremultiply(pixels, 3, 4)
+    return pixels
+
+
+def convert_ga8(row, width):
+    pixels = bytearray(row[:width * 2])
+    unpremultiply(pixels, 1, 2)
+    return pixels
+
+
+def convert_rgb5(row, width):
+    # 16 bit little endian pixels: 1 unused bit, then 5 bits per channel.
+    source = bytearray(row[:width * 2])
+    pixels = bytearray(width * 4)
+    for i in xrange(width):
+        value = source[i * 2] | source[i * 2 + 1] << 8
+        for j, shift in enumerate((10, 5, 0)):
+            channel = (value >> shift) & 0x1f
+            pixels[i * 4 + j] = (channel << 3) | (channel >> 2)
+
+        pixels[i * 4 + 3] = 255
+
+    return pixels
+
+
+# pixel format -> (bytes per pixel, row converter, png color type)
+PIXEL_FORMATS = {
+    "ARGB": (4, convert_argb, PNG_COLOR_RGBA),
+    "GA8": (2, convert_ga8, PNG_COLOR_GRAY_ALPHA),
+    "RGB5": (2, convert_rgb5, PNG_COLOR_RGBA),
+}
+
+
 class RenditionDecoder(object):
+    """
+    Turns a rendition payload into an image file. Bitmaps (CTSI renditions
+    with a CELM raw payload) are decompressed, converted to straight alpha
+    RGBA (or gray + alpha) and encoded as PNG; payloads already stored in a
+    file format (JPEG, PDF, ...) are written untouched.
 
-    def __init__(self, rendition):
+    Decoding is streamed: the payload is inflated chunk by chunk into bands of
+    rows that are converted and handed to the PNG encoder, so the working set
+    stays under `max_memory` whatever the image size.
+    """
+
+    def __init__(self, rendition, max_memory=DEFAULT_MAX_MEMORY):
         self.rendition = rendition
+        self.max_memory = max_memory
+
+    @property
+    def pixel_format(self):
+        return self.rendition.pixel_format.strip(" \x00")
+
+    @property
+    def extension(self):
+        return PASSTHROUGH_FORMATS.get(self.pixel_format, "png")
+
+    @property
+    def filename(self):
+        """
+        Deterministic file name: the rendition name, a digest of its key (so
+        variants never collide) and the scale suffix.
+        """
+        rendition = self.rendition
+        stem = os.path.splitext(os.path.basename(rendition.name))[0]
+        stem = re.sub(r"[^\w.@~-]", "_", stem) or "rendition"
+        digest = hashlib.sha1(getattr(rendition, "key", "")).hexdigest()[:8]
+        scale = rendition.scale_factor // 100
+        suffix = "@%dx" % scale if scale > 1 else ""
+        return "%s-%s%s.%s" % (stem, digest, suffix, self.extension)
 
     def decode(self):
-        raw = self.rendition.raw
+        """
+        Returns the contents of the image file for the rendition.
+        """
+        stream = StringIO.StringIO()
+        self.write(stream)
+        return stream.getvalue()
+
+    def write(self, stream):
+        """
+        Streams the image file for the rendition into the file-like `stream`.
+        """
+        rendition = self.rendition
+        raw = self._payload()
+        if self.pixel_format in PASSTHROUGH_FORMATS:
+            payload = raw.binary if raw.magic == "CELM" else rendition.content
+            for offset in xrange(0, len(payload), INPUT_CHUNK_SIZE):
+                stream.write(buffer(payload, offset, INPUT_CHUNK_SIZE))
+
+            return
+
+        self._check_bitmap(raw)
+        bpp, convert, color_type = PIXEL_FORMATS[self.pixel_format]
+        width, height = rendition.width, rendition.height
+        stride, band_rows = self._layout(bpp)
+        writer = PNGWriter(stream, width, height, color_type)
+        for band in self.bands(raw.binary, stride, height, band_rows):
+            rows = len(band) // stride
+            if vectorised.available:
+                image = vectorised.convert(band, width, rows, stride,
+                                           self.pixel_format)
+                writer.write(image.reshape(rows, -1))
+            else:
+                writer.write(convert(buffer(band, y * stride, stride), width)
+                             for y in xrange(rows))
+
+        writer.close()
+
+    def pixels(self):
+        """
+        Returns the bitmap as a (height, width, channels) uint8 NumPy array,
+        straight alpha RGBA or gray + alpha like the PNG written by `write`.
+        Requires NumPy.
+        """
+        if not vectorised.available:
+            raise RenditionDecoderError("NumPy is required to decode pixels")
+
+        rendition = self.rendition
+        raw = self._payload()
+        if self.pixel_format in PASSTHROUGH_FORMATS:
+            raise RenditionDecoderError("%s is a %s file, not a bitmap" %
+                                        (rendition.name, self.pixel_format))
+
+        self._check_bitmap(raw)
+        bpp = PIXEL_FORMATS[self.pixel_format][0]
+        width = rendition.width
+        stride, band_rows = self._layout(bpp)
+        image = vectorised.numpy.empty(
+            (rendition.height, width, 2 if self.pixel_format == "GA8" else 4),
+            vectorised.numpy.uint8)
+        y = 0
+        for band in self.bands(raw.binary, stride, rendition.height,
+                               band_rows):
+            rows = len(band) // stride
+            image[y:y + rows] = vectorised.convert(band, width, rows, stride,
+                                                   self.pixel_format)
+            y += rows
+
+        return image
+
+    def _payload(self):
+        rendition = self.rendition
+        if rendition.magic != "CTSI":
+            raise RenditionDecoderError("Invalid magic header %s" %
+                                        rendition.magic)
+
+        raw = rendition.raw
         if not raw:
-            print self.rendition
+            raise RenditionDecoderError("%s (%s) has no payload" %
+                                        (rendition.name, rendition.layout))
+
+        return raw
+
+    def _check_bitmap(self, raw):
+        if raw.magic != "CELM":
+            raise RenditionDecoderError("Invalid payload magic %s" %
+                                        raw.magic)
+
+        if self.pixel_format not in PIXEL_FORMATS:
+            raise RenditionDecoderError("Unsupported pixel format %s" %
+                                        self.pixel_format)
+
+    def _layout(self, bpp):
+        """
+        Returns (payload bytes per row, rows per band) for `bpp` bytes per
+        pixel.
+        """
+        width, height = self.rendition.width, self.rendition.height
+        stride = self.bytes_per_row or width * bpp
+        # Each band row is held decompressed three times (the band being
+        # converted, the next one being inflated and its copy handed out)
+        # and once converted, with temporaries.
+        working = vectorised.WORKING_BYTES_PER_PIXEL[self.pixel_format]
+        band_rows = self.max_memory // (stride * 3 + width * working)
+        return stride, min(max(band_rows, 1), max(height, 1))
+
+    @property
+    def bytes_per_row(self):
+        for info in self.rendition.info:
+            if isinstance(info.parsed, CARRenditionBytesPerRow):
+                return info.parsed.bytes_per_row
+
+    def bands(self, binary, stride, height, band_rows):
+        """
+        Yields the decompressed payload in bands of `band_rows` rows (the last
+        one may be shorter). Uncompressed payloads are sliced without copies.
+        """
+        band_size = stride * band_rows
+        size = stride * height
+        if len(binary) == size:
+            for offset in xrange(0, size, band_size):
+                yield buffer(binary, offset, band_size)
+
             return
 
-        if self.rendition.magic != "CTSI":
-            raise RenditionDecoderError("Invalid magic header %s (%s)" %
-                                        (raw.magic, self.rendition.magic))
+        pending = bytearray()
+        produced = 0
+        for piece in self.inflate(binary, min(band_size, INPUT_CHUNK_SIZE)):
+            pending.extend(piece)
+            # Bytes decompressed beyond `size` are ignored.
+            while produced < size and \
+                    len(pending) >= min(band_size, size - produced):
+                length = min(band_size, size - produced)
+                band = pending[:length]
+                del pending[:length]
+                produced += length
+                yield band
+
+            if produced == size:
+                return
+
+        raise RenditionDecoderError("Truncated payload for %s" %
+                                    self.rendition.name)
+
+    def inflate(self, binary, max_length):
+        """
+        Decompresses `binary` incrementally, never producing more than
+        `max_length` bytes per step.
+        """
+        decompressor = zlib.decompressobj()
+        try:
+            for offset in xrange(0, len(binary), INPUT_CHUNK_SIZE):
+                data = binary[offset:offset + INPUT_CHUNK_SIZE]
+                while data:
+                    yield decompressor.decompress(data, max_length)
+                    data = decompressor.unconsumed_tail
+
+            yield decompressor.flush()
+        except zlib.error:
+            raise RenditionDecoderError("Unsupported compression for %s "
+                                        "(%s...)" % (self.rendition.name,
+                                                     str(binary[:4])))
+
+    def save(self, directory):
+        """
+        Decodes the rendition into `directory` and returns the file path.
+        """
+        path = os.path.join(directory, self.filename)
+        try:
+            with open(path, "wb") as stream:
+                self.write(stream)
+        except Exception:
+            if os.path.exists(path):
+                os.remove(path)
+            raise
 
-        # TODO
+        return path
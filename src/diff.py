@@ -0,0 +1,148 @@
+from car import BLOCK_FACET_KEYS, BLOCK_RENDITIONS, IDENTIFIER_ATTRIBUTE
+
+
+class CARDiffError(Exception):
+    pass
+
+
+class TreeDiff(object):
+    """
+    Keys added to, removed from and whose value changed in a named tree.
+    """
+
+    def __init__(self):
+        self.added = []
+        self.removed = []
+        self.changed = []
+
+    def __len__(self):
+        return len(self.added) + len(self.removed) + len(self.changed)
+
+
+class CARDiff(object):
+    """
+    Differences between two car files `a` and `b`, as computed by `diff`.
+    `added`, `removed` and `changed` hold the names of plain named blocks
+    (header, key format, metadata...); named trees are compared entry by
+    entry into `trees` (name -> `TreeDiff`).
+    """
+
+    def __init__(self, a, b):
+        self.a = a
+        self.b = b
+        self.added = []
+        self.removed = []
+        self.changed = []
+        self.trees = {}
+
+    def __len__(self):
+        return len(self.added) + len(self.removed) + len(self.changed) + \
+            sum(len(x) for x in self.trees.itervalues())
+
+    @property
+    def facets(self):
+        return self.trees.get(BLOCK_FACET_KEYS, TreeDiff())
+
+    @property
+    def renditions(self):
+        return self.trees.get(BLOCK_RENDITIONS, TreeDiff())
+
+    def dump(self):
+        """
+        Prints one line per difference, `+` for added, `-` for removed and
+        `~` for changed entries.
+        """
+        for sign, names in (("+", self.added), ("-", self.removed),
+                            ("~", self.changed)):
+            for name in names:
+                print "%s block %s" % (sign, name)
+
+        for name, tree in sorted(self.trees.iteritems()):
+            if not tree:
+                continue
+
+            print "\n%s: %d added, %d removed, %d changed" % \
+                (name, len(tree.added), len(tree.removed), len(tree.changed))
+            describe = str
+            if name == BLOCK_RENDITIONS:
+                names = self._facet_names()
+                describe = lambda key: self._describe_rendition(key, names)
+
+            for sign, keys in (("+", tree.added), ("-", tree.removed),
+                               ("~", tree.changed)):
+                for key in keys:
+                    print "%s %s" % (sign, describe(key))
+
+    def _facet_names(self):
+        # Facet identifier -> name over both files, `b` taking precedence.
+        names = dict((identifier, name) for name, identifier in
+                     self.a.index.facets.iteritems())
+        names.update((identifier, name) for name, identifier in
+                     self.b.index.facets.iteritems())
+        return names
+
+    def _describe_rendition(self, key, names):
+        index = self.a.index
+        values = index.key_layout.unpack(key)
+        attributes = " ".join(
+            "%s=%d" % (x.identifier, value)
+            for x, value in zip(index.identifiers, values)
+            if value and x.identifier_raw != IDENTIFIER_ATTRIBUTE)
+        name = names.get(values[index.identifier_index], "?")
+        return "%s %s" % (name, attributes)
+
+
+def _same_block(a, a_index, b, b_index):
+    """
+    Whether two blocks hold the same bytes. Blocks of different size are
+    never read; equal sized ones are compared in place over the mappings.
+    """
+    block_a, block_b = a.blocks[a_index], b.blocks[b_index]
+    if block_a.size != block_b.size:
+        return False
+
+    return buffer(a.data, block_a.index, block_a.size) == \
+        buffer(b.data, block_b.index, block_b.size)
+
+
+def _diff_tree(a, tree_a, b, tree_b):
+    result = TreeDiff()
+    values_a = dict(tree_a.iterate_keys(a._stream_index))
+    for key, value_index in tree_b.iterate_keys(b._stream_index):
+        a_index = values_a.pop(key, None)
+        if a_index is None:
+            result.added.append(key)
+        elif not _same_block(a, a_index, b, value_index):
+            result.changed.append(key)
+
+    result.removed = sorted(values_a)
+    return result
+
+
+def diff(a, b):
+    """
+    Compares the car files `a` and `b` (`CARFile`s) and returns a `CARDiff`.
+    Only the ToCs, block tables and tree keys of both files are walked;
+    values are joined on their raw key bytes, and a value is only read when
+    the block on both sides has the same size. Unchanged payloads are never
+    decoded, so the cost is about that of reading the keys and the values
+    that may have changed.
+    """
+    a, b = a.snapshot, b.snapshot
+    if [x.identifier_raw for x in a.key_format.identifiers] != \
+            [x.identifier_raw for x in b.key_format.identifiers]:
+        raise CARDiffError("Rendition key formats differ, keys can't be "
+                           "joined")
+
+    result = CARDiff(a, b)
+    result.removed = sorted(set(a.table) - set(b.table))
+    result.added = sorted(set(b.table) - set(a.table))
+    for name in sorted(set(a.table) & set(b.table)):
+        tree_a = a._tree_at(a.table[name])
+        tree_b = b._tree_at(b.table[name])
+        if tree_a is not None and tree_b is not None:
+            result.trees[name] = _diff_tree(a, tree_a, b, tree_b)
+        elif not _same_block(a, a.table[name], b, b.table[name]):
+            result.changed.append(name)
+
+    return result
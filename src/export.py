@@ -0,0 +1,180 @@
+import multiprocessing
+import os
+import struct
+import sys
+
+import pixels as vectorised
+
+from itertools import chain, imap, izip
+
+from car import CARFile
+from decoders import RenditionDecoder, RenditionDecoderError, \
+                     DEFAULT_MAX_MEMORY
+from index import key_filter
+from pixels import encode_png
+
+
+# Offset of `CARRendition.layout_raw` in a rendition value.
+RENDITION_LAYOUT_OFFSET = 36
+
+LAYOUT_INTERNAL_LINK = 1003
+
+
+# The car file opened by each export worker.
+_car = None
+
+# The `RenditionCache` of a single process export.
+_cache = None
+
+
+def _open(path, sidecar):
+    global _car
+    _car = CARFile(path, lazy=True, sidecar=sidecar)
+
+
+def _export(task):
+    if isinstance(task, list):
+        return _export_links(task)
+
+    value_index, key, directory, max_memory = task
+    try:
+        if _cache is None:
+            rendition = _car.rendition_at(value_index, key)
+            decoder = RenditionDecoder(rendition, max_memory)
+            return decoder.save(directory), None
+
+        rendition = _cache.rendition(_car, value_index, key, lazy=True)
+        image = _cache.image(_car, value_index, key, max_memory)
+        path = os.path.join(directory, RenditionDecoder(rendition).filename)
+        with open(path, "wb") as stream:
+            stream.write(image)
+
+        return path, None
+    except RenditionDecoderError as error:
+        return None, str(error)
+
+
+def _export_links(tasks):
+    # An atlas and all its internal links: the atlas is decoded once and
+    # dropped after the last crop.
+    atlases = _car.atlases
+    max_memory = tasks[0][3]
+    renditions = [_car.rendition_at(value_index, key)
+                  for value_index, key, _, _ in tasks]
+    atlases.plan(renditions)
+    results = []
+    for rendition, (_, _, directory, _) in izip(renditions, tasks):
+        try:
+            image = encode_png(atlases.pixels(rendition, max_memory))
+        except RenditionDecoderError as error:
+            results.append((None, str(error)))
+            continue
+
+        path = os.path.join(directory, RenditionDecoder(rendition).filename)
+        with open(path, "wb") as stream:
+            stream.write(image)
+
+        results.append((path, None))
+
+    return results
+
+
+def _batch_links(car, tasks):
+    """
+    Groups the tasks of internal link renditions by atlas, together with the
+    task of the atlas itself, each group to be exported as one task; other
+    tasks are returned as is. Only the layout of
+    each rendition is read, plus the info of the links.
+    """
+    if not vectorised.available:
+        return tasks
+
+    batched = []
+    links = {}
+    for task in tasks:
+        block = car.blocks[task[0]]
+        layout = block.size > RENDITION_LAYOUT_OFFSET + 2 and \
+            struct.unpack_from("<H", car.data,
+                               block.index + RENDITION_LAYOUT_OFFSET)[0]
+        rendition = layout == LAYOUT_INTERNAL_LINK and \
+            car.rendition_at(task[0], task[1], lazy=True)
+        if not rendition or rendition.reference is None:
+            batched.append(task)
+            continue
+
+        key = car.atlases.atlas_key(rendition.reference)
+        if key not in links:
+            links[key] = []
+            batched.append(links[key])
+
+        links[key].append(task)
+
+    # Each atlas goes first in the batch of its links, which crop it.
+    result = []
+    for task in batched:
+        if not isinstance(task, list) and task[1] in links:
+            links[task[1]].insert(0, task)
+        else:
+            result.append(task)
+
+    return result
+
+
+def export(car, directory, jobs=1, max_memory=DEFAULT_MAX_MEMORY,
+           chunksize=32, cache=None, where=None):
+    """
+    Decodes every rendition of `car` into image files in `directory` and
+    returns their paths. With more than one job renditions are decoded on a
+    process pool where each worker opens the file once; file names only
+    depend on the renditions, not on the scheduling. Internal links to the
+    same atlas are exported together, decoding the atlas once (see
+    `AtlasCache`).
+
+    - parameter car:        The `CARFile` to export.
+    - parameter directory:  Output directory, created when missing.
+    - parameter jobs:       Number of worker processes.
+    - parameter max_memory: Decoding memory ceiling per worker, in bytes.
+    - parameter cache:      Optional `RenditionCache` images are taken from
+                            and stored into; only used with a single job.
+    - parameter where:      Only export the renditions whose key matches, see
+                            `CARFile.iter_renditions`.
+    """
+    global _car, _cache
+
+    car = car.snapshot
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    index = car.index
+    matches = key_filter(index.identifiers, where or {})
+    tasks = [(value_index, index.key_layout.pack(*values), directory,
+              max_memory)
+             for renditions in index.renditions.itervalues()
+             for values, value_index in renditions if matches(values)]
+    # Visit the values in block order so reads stay mostly sequential.
+    tasks.sort()
+    tasks = _batch_links(car, tasks)
+
+    pool = None
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs, _open, (car.path, car.sidecar))
+        results = pool.imap_unordered(_export, tasks, chunksize)
+    else:
+        _car, _cache = car, cache
+        results = imap(_export, tasks)
+
+    paths = []
+    try:
+        for path, error in chain.from_iterable(
+                x if isinstance(x, list) else [x] for x in results):
+            if error:
+                print >> sys.stderr, "Skipping rendition: %s" % error
+            else:
+                paths.append(path)
+    finally:
+        _cache = None
+        if pool:
+            pool.close()
+            pool.join()
+
+    return sorted(paths)
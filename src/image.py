@@ -0,0 +1,77 @@
+import cStringIO as StringIO
+import struct
+import zlib
+
+
+PNG_SIGNATURE = "\x89PNG\r\n\x1a\n"
+PNG_COLOR_GRAY_ALPHA = 4
+PNG_COLOR_RGBA = 6
+
+
+def png_chunk(kind, content):
+    crc = zlib.crc32(content, zlib.crc32(kind)) & 0xffffffff
+    return struct.pack(">I", len(content)) + kind + content + \
+        struct.pack(">I", crc)
+
+
+class PNGWriter(object):
+    """
+    Streaming PNG encoder. Rows are deflated as they are written and IDAT
+    chunks are flushed to the output every `chunk_size` compressed bytes, so
+    the whole image never needs to be held in memory.
+    """
+
+    def __init__(self, stream, width, height, color_type=PNG_COLOR_RGBA,
+                 level=6, chunk_size=64 * 1024):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.compressor = zlib.compressobj(level)
+        self.pending = []
+        self.pending_size = 0
+        header = struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0,
+                             0)
+        stream.write(PNG_SIGNATURE)
+        stream.write(png_chunk("IHDR", header))
+
+    def write(self, rows):
+        """
+        Appends 8-bit pixel rows (anything exposing the buffer interface, one
+        per image row, without padding).
+        """
+        # Filter type 0 (none) for every row, deflated one row at a time.
+        compress = self.compressor.compress
+        for row in rows:
+            self._queue(compress("\x00" + str(buffer(row))))
+
+    def close(self):
+        self._queue(self.compressor.flush())
+        self._flush()
+        self.stream.write(png_chunk("IEND", ""))
+
+    def _queue(self, data):
+        if not data:
+            return
+
+        self.pending.append(data)
+        self.pending_size += len(data)
+        if self.pending_size >= self.chunk_size:
+            self._flush()
+
+    def _flush(self):
+        if self.pending:
+            self.stream.write(png_chunk("IDAT", "".join(self.pending)))
+
+        self.pending = []
+        self.pending_size = 0
+
+
+def encode_png(width, height, rows, color_type=PNG_COLOR_RGBA):
+    """
+    Encodes 8-bit pixel rows as a PNG file and returns its contents, see
+    `PNGWriter.write`.
+    """
+    stream = StringIO.StringIO()
+    writer = PNGWriter(stream, width, height, color_type)
+    writer.write(rows)
+    writer.close()
+    return stream.getvalue()
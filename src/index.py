@@ -0,0 +1,169 @@
+import struct
+
+# NumPy is optional, only `RenditionTable` needs it.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class CARIndexError(Exception):
+    pass
+
+
+def key_filter(identifiers, where):
+    """
+    Compiles `where` into a predicate over decoded rendition keys, tuples of
+    attribute values ordered as `identifiers` (the `key_format`). `where` is
+    either a dict of attribute name -> accepted value or values, e.g.
+    `{"scale": 2, "idiom": [0, 1]}`, or a callable taking a dict of
+    attribute name -> value.
+    """
+    names = [x.identifier for x in identifiers]
+    if callable(where):
+        return lambda values: where(dict(zip(names, values)))
+
+    filters = []
+    for attribute, accepted in where.iteritems():
+        if attribute not in names:
+            raise CARIndexError("Unknown rendition attribute %s" % attribute)
+
+        if isinstance(accepted, (int, long)):
+            accepted = [accepted]
+
+        filters.append((names.index(attribute), frozenset(accepted)))
+
+    return lambda values: all(values[i] in accepted
+                              for i, accepted in filters)
+
+
+class CARIndex(object):
+    """
+    Hash index over the keys of a car file. It maps facet names to their
+    identifier, and identifiers to the keys of the renditions comprising the
+    facet together with the block index of each rendition value, so a lookup
+    only reads the values it returns.
+
+    The index is built from the FACETKEYS and RENDITIONS trees keys; rendition
+    values are never read while building it.
+    """
+
+    def __init__(self, identifiers, identifier_index):
+        """
+        - parameter identifiers:      The `key_format` identifiers, in order.
+        - parameter identifier_index: Position of the facet identifier
+                                      attribute in every rendition key.
+        """
+        self.identifiers = identifiers
+        self.identifier_index = identifier_index
+        self.columns = dict((x.identifier, i)
+                            for i, x in enumerate(identifiers))
+        self.key_layout = struct.Struct("<%dH" % len(identifiers))
+        self.facets = {}
+        self.renditions = {}
+
+    def add_facet(self, name, identifier):
+        self.facets[name] = identifier
+
+    def add_rendition(self, key, value_index):
+        """
+        Indexes a raw rendition key pointing to the value at `value_index`.
+        Returns the decoded attribute values.
+        """
+        values = self.key_layout.unpack(key)
+        self.add_values(values, value_index)
+        return values
+
+    def add_values(self, values, value_index):
+        """
+        Indexes an already decoded rendition key (a tuple of attribute values).
+        """
+        identifier = values[self.identifier_index]
+        self.renditions.setdefault(identifier, []).append((values,
+                                                           value_index))
+
+    def find(self, name, **attributes):
+        """
+        Returns the (attribute values, value index) pairs of all renditions of
+        the facet `name` matching every given attribute, e.g. `scale=2`.
+        """
+        identifier = self.facets.get(name)
+        if identifier is None:
+            return []
+
+        filters = []
+        for attribute, value in attributes.iteritems():
+            if attribute not in self.columns:
+                raise CARIndexError("Unknown rendition attribute %s" %
+                                    attribute)
+
+            filters.append((self.columns[attribute], value))
+
+        return [(values, value_index)
+                for values, value_index in self.renditions.get(identifier, [])
+                if all(values[i] == value for i, value in filters)]
+
+
+class RenditionTable(object):
+    """
+    Columnar view of every rendition key of a car file: an (N, identifiers)
+    uint16 array with one column per `key_format` identifier, plus the value
+    block index of each row. Queries are vectorised boolean masks and only
+    the selected rows are parsed into renditions:
+
+        table = car.rendition_table
+        mask = table.where(scale=3, appearance=1, idiom=2)
+        renditions = table.select(mask)
+    """
+
+    def __init__(self, car, columns, keys, value_indexes):
+        """
+        - parameter car:           The `CARSnapshot` the keys belong to.
+        - parameter columns:       Identifier names, in key order.
+        - parameter keys:          All raw keys, concatenated.
+        - parameter value_indexes: Value block index of each key (array).
+        """
+        if numpy is None:
+            raise CARIndexError("NumPy is required for rendition tables")
+
+        self.car = car
+        self.columns = columns
+        self.keys = numpy.frombuffer(keys, "<u2").reshape(-1, len(columns))
+        self.value_indexes = numpy.frombuffer(value_indexes, numpy.uint32)
+
+    def __len__(self):
+        return len(self.value_indexes)
+
+    def __getitem__(self, column):
+        """
+        The values of the attribute `column` for every rendition (a view).
+        """
+        if column not in self.columns:
+            raise CARIndexError("Unknown rendition attribute %s" % column)
+
+        return self.keys[:, self.columns.index(column)]
+
+    def where(self, **attributes):
+        """
+        Boolean mask of the rows matching every given attribute value. Values
+        can also be sequences, matching any of them.
+        """
+        mask = numpy.ones(len(self), dtype=bool)
+        for column, value in attributes.iteritems():
+            if isinstance(value, (list, tuple, set)):
+                mask &= numpy.in1d(self[column], list(value))
+            else:
+                mask &= self[column] == value
+
+        return mask
+
+    def select(self, mask, lazy=None):
+        """
+        Parses the renditions of the rows selected by `mask` (a boolean mask
+        or an array of row numbers).
+        """
+        rows = numpy.flatnonzero(mask) if numpy.asarray(mask).dtype == bool \
+            else mask
+        return [self.car.rendition_at(int(self.value_indexes[row]),
+                                      self.keys[row].tostring(), lazy)
+                for row in rows]
@@ -0,0 +1,87 @@
+import time
+
+
+# The `Profile` collecting counters, None while instrumentation is off. Hooks
+# read it once per call and skip all accounting when unset, so they can stay
+# in place at the cost of a global lookup.
+active = None
+
+
+class Profile(object):
+    """
+    Parse counters gathered by the hooks in `Model.make`,
+    `CARSnapshot._stream_index` and `BOMTree.iterate_keys`:
+
+    - blocks read from the block table and their bytes; a seek is a block
+      read that does not start where the previous one ended,
+    - tree leaves visited and entries yielded,
+    - records built and bytes parsed per model class,
+    - calls and seconds spent per field parser.
+    """
+
+    def __init__(self):
+        self.blocks = 0
+        self.bytes = 0
+        self.seeks = 0
+        self.leaves = 0
+        self.entries = 0
+        self.records = {}
+        self.fields = {}
+        self.position = None
+        self.started = time.time()
+
+    def read_block(self, block):
+        if block.index != self.position:
+            self.seeks += 1
+
+        self.blocks += 1
+        self.bytes += block.size
+        self.position = block.index + block.size
+
+    def record(self, cls, size):
+        count, total = self.records.get(cls.__name__, (0, 0))
+        self.records[cls.__name__] = (count + 1, total + size)
+
+    def field(self, cls, names, seconds):
+        # Consecutive fixed size fields are parsed as one step: first..last.
+        if not isinstance(names, str):
+            names = names[0] if len(names) == 1 else \
+                "%s..%s" % (names[0], names[-1])
+
+        key = "%s.%s" % (cls.__name__, names)
+        calls, total = self.fields.get(key, (0, 0.0))
+        self.fields[key] = (calls + 1, total + seconds)
+
+    def dump(self):
+        print "Elapsed: %.4fs" % (time.time() - self.started)
+        print "Blocks read: %d (%d bytes, %d seeks)" % \
+            (self.blocks, self.bytes, self.seeks)
+        print "Tree leaves: %d, entries: %d\n" % (self.leaves, self.entries)
+
+        print "%-32s %10s %12s" % ("Model", "Records", "Bytes")
+        for name, (count, size) in sorted(self.records.iteritems(),
+                                          key=lambda x: -x[1][0]):
+            print "%-32s %10d %12d" % (name, count, size)
+
+        print "\n%-40s %10s %10s" % ("Field", "Calls", "Seconds")
+        for name, (calls, seconds) in sorted(self.fields.iteritems(),
+                                             key=lambda x: -x[1][1]):
+            print "%-40s %10d %10.4f" % (name, calls, seconds)
+
+
+def enable():
+    """
+    Starts collecting into a new `Profile`, which is returned.
+    """
+    global active
+    active = Profile()
+    return active
+
+
+def disable():
+    """
+    Stops collecting and returns the last `Profile`, if any.
+    """
+    global active
+    profile, active = active, None
+    return profile
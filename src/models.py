@@ -1,6 +1,9 @@
-import cStringIO as StringIO
 import struct
+import time
 
+import instrument
+from itertools import izip
+from stream import BufferStream
 from utils import cached_property
 from parse import CAR_ATTRIBUTE_BY_ID, CAR_RENDITION_LAYOUT_BY_ID, Parse
 
@@ -9,32 +12,240 @@ class CARParsingError(Exception):
     pass
 
 
+class ModelType(type):
+    """
+    Compiles the `fields` declaration of every model into parsing steps once,
+    at class creation, so `make` does not need to interpret it on each call.
+
+    Models are also turned into slotted records: fields, `custom` and `extra`
+    attributes get a slot instead of a per-instance `__dict__`, which is only
+    kept for models using `cached_property`. Models made of fixed size fields
+    share `metadata_size` as a class attribute.
+    """
+
+    def __new__(mcs, name, bases, attrs):
+        fields = attrs.get("fields", getattr(bases[0], "fields", []))
+        lazy = attrs.get("lazy", getattr(bases[0], "lazy", []))
+        eager = len(fields) - len(lazy)
+        if [field for field, _ in fields[eager:]] != list(lazy):
+            raise TypeError("%s.lazy must name the trailing fields" % name)
+
+        steps = Parse.compile(fields)
+        fixed_size = None
+        if all(layout is not None for layout, _, _, _ in steps):
+            fixed_size = sum(layout.size for layout, _, _, _ in steps)
+            attrs["metadata_size"] = fixed_size
+
+        if "__slots__" not in attrs:
+            attrs["__slots__"] = mcs._slots(bases, attrs, fields, lazy,
+                                            fixed_size is None)
+
+        cls = type.__new__(mcs, name, bases, attrs)
+        cls._steps = steps
+        cls._eager_steps = Parse.compile(fields[:eager])
+        cls._lazy_fields = fields[eager:]
+        cls._fixed_size = fixed_size
+        cls._slot_descriptors = [
+            (slot, klass.__dict__[slot]) for klass in cls.__mro__
+            for slot in klass.__dict__.get("__slots__", ())
+            if slot != "__dict__"]
+        return cls
+
+    @staticmethod
+    def _slots(bases, attrs, fields, lazy, variable_size):
+        inherited = set()
+        for base in bases:
+            for klass in base.__mro__:
+                inherited.update(getattr(klass, "__slots__", ()))
+
+        names = [field for field, _ in fields]
+        names += attrs.get("custom", []) + attrs.get("extra", [])
+        names += ["metadata_size"] if variable_size else []
+        names += ["_deferred"] if lazy else []
+
+        slots = []
+        needs_dict = any(isinstance(value, cached_property)
+                         for value in attrs.itervalues())
+        for slot in names:
+            if slot in attrs:
+                needs_dict = True
+            elif slot not in inherited and slot not in slots:
+                slots.append(slot)
+
+        if needs_dict and "__dict__" not in inherited:
+            slots.append("__dict__")
+
+        return tuple(slots)
+
+
 class Model(object):
+    __metaclass__ = ModelType
 
     custom = []
+    fields = []
+
+    # Attributes assigned after parsing (e.g. by `make` keyword arguments)
+    # that need a slot.
+    extra = []
+
+    # Trailing fields that are only parsed on first access when the instance
+    # is made with `lazy=True`.
+    lazy = []
 
     def __init__(self, **kwargs):
-        self.metadata_size = 0
+        if self._fixed_size is None:
+            self.metadata_size = 0
+
         for field, _ in self.__class__.fields:
             setattr(self, field, kwargs.get(field))
 
     @classmethod
-    def make(cls, stream, **kwargs):
-        instance = cls()
+    def make(cls, stream, lazy=False, **kwargs):
+        """
+        Parses an instance from the current position of `stream`. When `lazy`
+        is set only the fields before `cls.lazy` are decoded and the rest are
+        parsed from the same buffer on first access; `metadata_size` then only
+        accounts for the eagerly parsed fields.
+        """
+        instance = cls.__new__(cls)
         start = stream.tell()
-        for field, unpack in cls.fields:
-            setattr(instance, field, unpack(instance, stream))
+        profile = instrument.active
+        parse_steps = cls._parse_steps if profile is None else \
+            cls._profile_steps
+        if lazy and cls.lazy:
+            parse_steps(instance, cls._eager_steps, stream)
+            offsets = [stream.tell()] + [None] * len(cls.lazy)
+            instance._deferred = (stream.data, offsets)
+        else:
+            parse_steps(instance, cls._steps, stream)
 
         for key, value in kwargs.iteritems():
             setattr(instance, key, value)
 
-        instance.metadata_size = stream.tell() - start
+        if cls._fixed_size is None:
+            instance.metadata_size = stream.tell() - start
+
+        if profile is not None:
+            profile.record(cls, stream.tell() - start)
+
         return instance
 
+    @staticmethod
+    def _parse_steps(instance, steps, stream):
+        for layout, names, reverse, unpack in steps:
+            if layout is None:
+                setattr(instance, names, unpack(instance, stream))
+                continue
+
+            values = stream.unpack(layout)
+            if reverse:
+                values = list(values)
+                for i in reverse:
+                    values[i] = values[i][::-1]
+
+            for name, value in izip(names, values):
+                setattr(instance, name, value)
+
+    @staticmethod
+    def _profile_steps(instance, steps, stream):
+        """
+        `_parse_steps` timing every step into the active `Profile`.
+        """
+        for step in steps:
+            start = time.time()
+            Model._parse_steps(instance, (step,), stream)
+            instrument.active.field(instance.__class__, step[1],
+                                    time.time() - start)
+
+    def _resolve(self, name):
+        """
+        Parses the deferred field `name`. Preceding deferred fields whose byte
+        size is known upfront (their parser exposes `span`) are skipped
+        instead of parsed.
+        """
+        cls = self.__class__
+        data, offsets = self._deferred
+        target = cls.lazy.index(name)
+        position = max(i for i in xrange(target + 1) if offsets[i] is not None)
+        stream = BufferStream(data)
+        for i in xrange(position, target + 1):
+            field, parse = cls._lazy_fields[i]
+            stream.seek(offsets[i])
+            span = getattr(parse, "span", None)
+            if i < target and span is not None:
+                stream.seek(offsets[i] + span(self))
+            elif not self._is_set(field):
+                setattr(self, field, parse(self, stream))
+            else:
+                parse(self, stream)
+
+            offsets[i + 1] = stream.tell()
+
+        return object.__getattribute__(self, name)
+
+    def _is_set(self, name):
+        try:
+            object.__getattribute__(self, name)
+            return True
+        except AttributeError:
+            return False
+
+    def __getattr__(self, name):
+        if name not in self.__class__.lazy or not self._is_set("_deferred"):
+            raise AttributeError(name)
+
+        return self._resolve(name)
+
+    def __getstate__(self):
+        # Slotted records have no `__dict__` for pickle to save, so every set
+        # slot is collected. Deferred fields are parsed first and buffers
+        # copied, as views over the file can't be pickled.
+        for name in self.__class__.lazy:
+            getattr(self, name)
+
+        return dict((name, str(value) if isinstance(value, buffer) else value)
+                    for name, value in self._attributes()
+                    if name != "_deferred")
+
+    def _attributes(self):
+        """
+        Yields the (name, value) of every set slot and `__dict__` entry,
+        without parsing deferred fields.
+        """
+        for item in getattr(self, "__dict__", {}).iteritems():
+            yield item
+
+        for slot, descriptor in self._slot_descriptors:
+            try:
+                yield slot, descriptor.__get__(self)
+            except AttributeError:
+                continue
+
+    def __setstate__(self, state):
+        for name, value in state.iteritems():
+            setattr(self, name, value)
+
     @classmethod
     def make_from_buffer(cls, buffer, **kwargs):
-        stream = StringIO.StringIO(buffer)
-        return cls.make(stream, **kwargs)
+        return cls.make(BufferStream(buffer), **kwargs)
+
+    def pack(self):
+        """
+        Serialises a model made of fixed size fields, the inverse of `make`.
+        """
+        if self._fixed_size is None:
+            raise CARParsingError("%s is not a fixed size model" %
+                                  self.__class__.__name__)
+
+        content = []
+        for layout, names, reverse, _ in self._steps:
+            values = [getattr(self, name) for name in names]
+            for i in reverse:
+                values[i] = values[i][::-1]
+
+            content.append(layout.pack(*values))
+
+        return "".join(content)
 
     def __repr__(self):
         return repr(str(self))
@@ -43,7 +254,7 @@ class Model(object):
         cls = self.__class__
         attrs = ["%s=%s" % (field, getattr(self, field))
                  for field, _ in cls.fields if field != "reserved"]
-        attrs += ["%s=%s" % (field, getattr(self, field))
+        attrs += ["%s=%s" % (field, getattr(self, field, None))
                   for field in cls.custom]
         return "<%s %s>" % (cls.__name__, ", ".join(attrs))
 
@@ -91,6 +302,9 @@ class CARKeyFormatIdentifier(Model):
     def __eq__(self, other):
         return self.identifier_raw == other.identifier_raw
 
+    def __hash__(self):
+        return hash(self.identifier_raw)
+
     @property
     def identifier(self):
         return CAR_ATTRIBUTE_BY_ID.get(self.identifier_raw, "unknown")
@@ -174,8 +388,19 @@ class CARRenditionReference(Model):
         ('height', Parse.fixed("<I")),
         ('layout', Parse.fixed("<H")),
         ('key_length', Parse.fixed("<H")),
+        ('key', Parse.dynamic("key_length")),
     ]
 
+    @cached_property
+    def tokens(self):
+        """
+        Attribute identifier -> value of the referenced rendition key, stored
+        as (identifier, value) uint16 pairs.
+        """
+        values = struct.unpack("<%dH" % (len(self.key) // 4 * 2),
+                               self.key[:len(self.key) // 4 * 4])
+        return dict(zip(values[0::2], values[1::2]))
+
 
 class CARRenditionInfo(Model):
     fields = [
@@ -186,7 +411,7 @@ class CARRenditionInfo(Model):
 
     @cached_property
     def parsed(self):
-        content = StringIO.StringIO(self.content)
+        content = BufferStream(self.content)
         make_map = {
             1001: Parse.array_dynamic(model=CARRenditionSlice),
             1003: Parse.array_dynamic(model=CARRenditionMetric),
@@ -213,6 +438,7 @@ class CARFacetAttribute(Model):
 
 class CARFacet(Model):
     custom = ['name']
+    extra = ['car', 'attributes']
     fields = [
         ('x', Parse.fixed("<H")),
         ('y', Parse.fixed("<H")),
@@ -221,6 +447,13 @@ class CARFacet(Model):
                                        count="attributes_count")),
     ]
 
+    @property
+    def renditions(self):
+        """
+        Renditions comprising this facet, resolved through the file index.
+        """
+        return self.car.lookup(self.name)
+
     def dump(self):
         print "Facet: %s" % self.name
         for attribute, value in self.attributes.iteritems():
@@ -228,6 +461,45 @@ class CARFacet(Model):
                 (attribute.identifier_raw, attribute.identifier, value)
 
 
+class CARNamedIdentifier(Model):
+    """
+    Value of the ELEMENT_INFO and PART_INFO trees, keyed by name.
+    """
+    fields = [
+        ('identifier', Parse.fixed("<I")),
+    ]
+
+
+class CARColor(Model):
+    """
+    Value of the COLORS tree, keyed by color name: a BGRA quad.
+    """
+    fields = [
+        ('version', Parse.fixed("<I")),
+        ('blue', Parse.fixed("<B")),
+        ('green', Parse.fixed("<B")),
+        ('red', Parse.fixed("<B")),
+        ('alpha', Parse.fixed("<B")),
+    ]
+
+    @property
+    def components(self):
+        return self.red, self.green, self.blue, self.alpha
+
+
+class CARBitmapKey(Model):
+    """
+    Value of the BITMAPKEYS tree, keyed by facet identifier: the attribute
+    tokens of the bitmap.
+    """
+    fields = [
+        ('version', Parse.fixed("<I")),
+        ('attributes_count', Parse.fixed("<I")),
+        ('attributes_raw', Parse.array(model=CARFacetAttribute,
+                                       count="attributes_count")),
+    ]
+
+
 class CARRenditionRaw(Model):
     fields = [
         ('magic', Parse.fixed("<4s")),
@@ -244,11 +516,8 @@ class CARRendition(Model):
     RESIZE_MODE_HUNIFORM_VSCALE = "Horizontal Uniform; Vertical Scale"
     RESIZE_MODE_HSCALE_VUNIFORM = "Horizontal Scale; Vertical Uniform"
 
-    @classmethod
-    def make_from_buffer(cls, buffer, **kwargs):
-        stream = StringIO.StringIO(buffer)
-        return cls.make(stream, **kwargs)
-
+    extra = ['attributes', 'key']
+    lazy = ['info', 'content']
     fields = [
         ('magic', Parse.fixed("<4s")),
         ('version', Parse.fixed("<I")),
@@ -282,11 +551,25 @@ class CARRendition(Model):
 
     @cached_property
     def is_resizable(self):
-        return 25 >= self.layout_raw >= 20 and len(self.slices) > 1
+        return 34 >= self.layout_raw >= 20 and len(self.slices) > 1
 
     @cached_property
     def slices(self):
-        return filter(lambda x: x.parsed is CARRenditionSlice, self.info)
+        for info in self.info:
+            if info.magic == 1001:
+                return info.parsed
+
+        return []
+
+    @cached_property
+    def reference(self):
+        """
+        The `CARRenditionReference` of internal link renditions, locating
+        their pixels inside another (packed) rendition, or None.
+        """
+        for info in self.info:
+            if info.magic == 1010:
+                return info.parsed
 
     @cached_property
     def resize_mode(self):
@@ -301,7 +584,7 @@ class CARRendition(Model):
             "nine_part_scale": CARRendition.RESIZE_MODE_SCALE,
             "nine_part_horizontal_uniform_vertical_scale":
                 CARRendition.RESIZE_MODE_HUNIFORM_VSCALE,
-            "nine_part_horizontal_uniform_vertical_scale":
+            "nine_part_horizontal_scale_vertical_uniform":
                 CARRendition.RESIZE_MODE_HSCALE_VUNIFORM,
         }
         return mode_map.get(self.layout, CARRendition.RESIZE_MODE_FIXED)
@@ -56,29 +56,66 @@ CAR_RENDITION_LAYOUT_BY_ID = {
 
 
 class Parse(object):
-    sizes = {"I": 4, "?": 1, "b": 1, "B": 1, "H": 2, "f": 4}
+    terminated_chunk = 256
+
+    @classmethod
+    def compile(cls, fields):
+        """
+        Compiles a model `fields` declaration into a list of parsing steps.
+        Consecutive fixed fields sharing the same byte order are merged into a
+        single precompiled `struct.Struct`, every other field is kept as its
+        parser. Each step is a tuple (layout, names, reversed, parse) where
+        `layout` is None for non-fixed steps.
+        """
+        steps = []
+        run = []
+
+        def flush():
+            if not run:
+                return
+
+            order = run[0][1].format[0]
+            layout = struct.Struct(order + "".join(p.format[1:]
+                                                   for _, p in run))
+            names = tuple(name for name, _ in run)
+            reverse = tuple(i for i, (_, p) in enumerate(run) if p.reverse)
+            steps.append((layout, names, reverse, None))
+            del run[:]
+
+        for name, parse in fields:
+            if getattr(parse, "format", None) is None:
+                flush()
+                steps.append((None, name, (), parse))
+                continue
+
+            if run and run[0][1].format[0] != parse.format[0]:
+                flush()
+
+            run.append((name, parse))
+
+        flush()
+        return steps
 
     @classmethod
     def fixed(cls, size_identifier):
+        layout = struct.Struct(size_identifier)
+        reverse = size_identifier[0] == "<" and size_identifier[-1] == "s"
+
         def parse(instance, stream):
-            if len(size_identifier) > 2:
-                size = int(size_identifier[1:-1])
-                identifier = size_identifier[-1]
-            else:
-                size = cls.sizes[size_identifier[1:]]
-
-            content, = struct.unpack(size_identifier, stream.read(size))
-            reverse = size_identifier[0] == "<" and size_identifier[-1] == "s"
+            content, = stream.unpack(layout)
             return content[::-1] if reverse else content
 
+        parse.format = size_identifier
+        parse.reverse = reverse
         return parse
 
     @classmethod
     def dynamic(cls, size_field):
         def parse(instance, stream):
             size = int(getattr(instance, size_field))
-            return struct.unpack("<%ds" % size, stream.read(size))[0]
+            return stream.view(size)
 
+        parse.span = lambda instance: int(getattr(instance, size_field))
         return parse
 
     @classmethod
@@ -102,6 +139,11 @@ class Parse(object):
 
             return content
 
+        if size and not isinstance(size, int):
+            parse.span = lambda instance: int(getattr(instance, size))
+        else:
+            parse.span = lambda instance: size
+
         return parse
 
     @classmethod
@@ -126,17 +168,23 @@ class Parse(object):
     @classmethod
     def terminated(cls, terminator, fixed=0):
         def parse(instance, stream):
-            parsed = ""
-            while True:
-                char = stream.read(1)
-                if char == terminator:
-                    break
-
-                parsed += char
-
-            if fixed - len(parsed) > 0:
-                stream.read(fixed - len(parsed) - 1)
-
-            return parsed
+            start = stream.tell()
+            parsed = stream.read(fixed or cls.terminated_chunk)
+            end = parsed.find(terminator)
+            while end < 0:
+                chunk = stream.read(cls.terminated_chunk)
+                if not chunk:
+                    return parsed
+
+                searched = len(parsed)
+                parsed += chunk
+                end = parsed.find(terminator, searched)
+
+            # Fixed size strings always consume `fixed` bytes, otherwise we
+            # stop right after the terminator.
+            if end >= fixed:
+                stream.seek(start + end + 1)
+
+            return parsed[:end]
 
         return parse
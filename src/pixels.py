@@ -0,0 +1,116 @@
+# Vectorised conversion of decompressed rendition payloads: every stage is a
+# whole-array operation over a NumPy view of the buffer. NumPy is optional,
+# `available` is False without it and `decoders` falls back to its row by row
+# converters.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import image as png
+
+
+available = numpy is not None
+
+# pixel format -> bytes per pixel in the payload
+BYTES_PER_PIXEL = {
+    "ARGB": 4,
+    "GA8": 2,
+    "RGB5": 2,
+}
+
+# pixel format -> bytes held per pixel while `convert` runs: the converted
+# pixels, plus the 16 bit color and alpha copies and the mask used by
+# `unpremultiply`, or the 16 bit values and channel bits of `convert_rgb5`.
+WORKING_BYTES_PER_PIXEL = {
+    "ARGB": 4 + 3 * 2 + 2 * 2 + 1,
+    "GA8": 2 + 1 * 2 + 2 * 2 + 1,
+    "RGB5": 2 + 2 + 4 + 2,
+}
+
+
+def view(data, width, height, stride, bpp):
+    """
+    Returns a (height, width, bpp) uint8 view over `data`, dropping the row
+    padding beyond `width * bpp` bytes without copying.
+    """
+    rows = numpy.frombuffer(data, numpy.uint8, count=stride * height)
+    rows = rows.reshape(height, stride)[:, :width * bpp]
+    return rows.reshape(height, width, bpp)
+
+
+def unpremultiply(pixels):
+    """
+    Converts premultiplied pixels (color channels followed by alpha in the
+    last channel) to straight alpha, in place. Temporaries are updated in
+    place, see `WORKING_BYTES_PER_PIXEL`.
+    """
+    alpha = pixels[..., -1:]
+    partial = alpha > 0
+    partial &= alpha < 255
+    if not partial.any():
+        return pixels
+
+    color = pixels[..., :-1].astype(numpy.uint16)
+    color *= 255
+    divisor = alpha.astype(numpy.uint16)
+    divisor //= 2
+    color += divisor
+    numpy.maximum(alpha, 1, out=divisor)
+    color //= divisor
+    numpy.minimum(color, 255, out=color)
+    numpy.copyto(pixels[..., :-1], color, where=partial)
+    return pixels
+
+
+def convert_argb(pixels):
+    # Little endian ARGB is premultiplied BGRA in memory.
+    return unpremultiply(pixels[..., [2, 1, 0, 3]])
+
+
+def convert_ga8(pixels):
+    return unpremultiply(pixels.copy())
+
+
+def convert_rgb5(pixels):
+    height, width = pixels.shape[:2]
+    values = pixels.copy().view("<u2").reshape(height, width)
+    image = numpy.empty((height, width, 4), numpy.uint8)
+    for channel, shift in enumerate((10, 5, 0)):
+        bits = ((values >> shift) & 0x1f).astype(numpy.uint8)
+        image[..., channel] = (bits << 3) | (bits >> 2)
+
+    image[..., 3] = 255
+    return image
+
+
+CONVERTERS = {
+    "ARGB": convert_argb,
+    "GA8": convert_ga8,
+    "RGB5": convert_rgb5,
+}
+
+
+def convert(data, width, height, stride, pixel_format):
+    """
+    Converts a decompressed payload into a (height, width, channels) uint8
+    array, RGBA for color formats and gray + alpha for GA8.
+
+    - parameter data:         Decompressed payload (str, buffer, bytearray).
+    - parameter stride:       Bytes per payload row, including padding.
+    - parameter pixel_format: Rendition pixel format, e.g. "ARGB".
+    """
+    bpp = BYTES_PER_PIXEL[pixel_format]
+    return CONVERTERS[pixel_format](view(data, width, height, stride, bpp))
+
+
+def encode_png(image):
+    """
+    Returns the PNG file contents for a (height, width, channels) uint8
+    image, RGBA or gray + alpha as returned by `convert`.
+    """
+    height, width, channels = image.shape
+    color_type = png.PNG_COLOR_GRAY_ALPHA if channels == 2 else \
+        png.PNG_COLOR_RGBA
+    return png.encode_png(width, height, image.reshape(height, -1),
+                          color_type)
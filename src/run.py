@@ -1,31 +1,175 @@
 import argparse
+import time
 
+import instrument
 from car import CARFile
-from decoders import RenditionDecoder
+from diff import diff
+from export import export
+from index import CARIndexError
+from scan import scan
+from server import serve
+from sidecar import CARSidecar
+from thin import thin
+
+
+# Rendition attributes that can filter -s and -o from the command line.
+FILTER_ATTRIBUTES = ["scale", "idiom", "appearance"]
 
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("filepath", help="Full path of the file to be parsed")
+    parser.add_argument("filepath", help="Full path of the file to be parsed",
+                        nargs="?")
     parser.add_argument("-s", help="Dump CAR information", dest="show",
                         action='store_true')
     parser.add_argument("-o", help="Dump all images into the given directory",
                         dest="directory")
+    parser.add_argument("-j", help="Number of processes used to export "
+                        "images with -o or scan with --scan, or of decoding "
+                        "threads with --serve", dest="jobs",
+                        type=int, default=1)
+    parser.add_argument("--max-memory", help="Memory ceiling in MB for "
+                        "decoding each image with -o", dest="max_memory",
+                        type=int, default=16)
+    parser.add_argument("--cache", help="Directory for the sidecar index "
+                        "cache, reused while the file is unchanged",
+                        dest="cache")
+    parser.add_argument("--scan", help="Scan every car file in the given "
+                        "directory into a SQLite catalogue", dest="scan")
+    parser.add_argument("--catalogue", help="SQLite catalogue written by "
+                        "--scan", dest="catalogue", default="catalogue.db")
+    parser.add_argument("--name", help="Only dump or export the renditions "
+                        "of the given facet", dest="name")
+    for attribute in FILTER_ATTRIBUTES:
+        parser.add_argument("--" + attribute, help="Only dump or export the "
+                            "renditions with the given %s" % attribute,
+                            dest=attribute, type=int)
+    parser.add_argument("--thin", help="Write a copy of the file keeping "
+                        "only the renditions matching --keep, with identical "
+                        "payloads shared", dest="thin")
+    parser.add_argument("--keep", help="attribute=value[,value...] filter "
+                        "for --thin, e.g. idiom=1 or scale=2,3; can be "
+                        "repeated", dest="keep", action="append", default=[])
+    parser.add_argument("--diff", help="Compare the file with the given "
+                        "one, listing added, removed and changed blocks, "
+                        "facets and renditions", dest="diff")
+    parser.add_argument("--serve", help="Serve the images of every car file "
+                        "in the given directory over HTTP at "
+                        "/<file>/<facet>?scale=&idiom=&appearance=",
+                        dest="serve")
+    parser.add_argument("--port", help="Port for --serve, on localhost",
+                        dest="port", type=int, default=8000)
+    parser.add_argument("--memory-cache", help="Size in MB of the decoded "
+                        "image cache of --serve", dest="memory_cache",
+                        type=int, default=64)
+    parser.add_argument("--watch", help="Keep running and reload the file, "
+                        "or the files served with --serve, when they change; "
+                        "polls every given number of seconds. Watched files "
+                        "are read into memory instead of mapped, so they can "
+                        "be rewritten in place", dest="watch", type=float)
+    parser.add_argument("--profile", help="Print blocks read, records built "
+                        "and time spent per field parser; -o and --scan "
+                        "need -j 1", dest="profile", action="store_true")
     arguments = parser.parse_args()
+    if arguments.profile and arguments.jobs > 1 and \
+            (arguments.directory or arguments.scan):
+        parser.error("--profile only counts this process, use -j 1 with -o "
+                     "and --scan")
+
+    if arguments.profile:
+        instrument.enable()
+
+    try:
+        run(parser, arguments)
+    finally:
+        if arguments.profile:
+            instrument.disable().dump()
+
+
+def parse_keep(parser, rules):
+    """
+    Returns the attribute -> values dict of the --keep `rules`, exiting with
+    a usage error on a malformed one.
+    """
+    keep = {}
+    for rule in rules:
+        attribute, _, values = rule.partition("=")
+        try:
+            if not attribute:
+                raise ValueError(rule)
+
+            keep[attribute] = [int(x) for x in values.split(",")]
+        except ValueError:
+            parser.error("--keep %s: expected attribute=value[,value...] "
+                         "with integer values" % rule)
+
+    return keep
+
+
+def run(parser, arguments):
+    keep = parse_keep(parser, arguments.keep)
+    sidecar = CARSidecar(arguments.cache) if arguments.cache else None
+    if arguments.scan:
+        scan(arguments.scan, arguments.catalogue, arguments.jobs)
+
+    if arguments.serve:
+        serve(arguments.serve, port=arguments.port, jobs=arguments.jobs,
+              max_memory=arguments.max_memory * 1024 * 1024, sidecar=sidecar,
+              cache_budget=arguments.memory_cache * 1024 * 1024,
+              watch=arguments.watch)
+
+    if not arguments.filepath:
+        if not arguments.scan and not arguments.serve:
+            parser.error("a file path, --scan or --serve is required")
+
+        return
+
+    content = CARFile(arguments.filepath, sidecar=sidecar,
+                      mapped=not arguments.watch)
+    where = dict((attribute, getattr(arguments, attribute))
+                 for attribute in FILTER_ATTRIBUTES
+                 if getattr(arguments, attribute) is not None)
+    if arguments.name is not None:
+        identifier = content.facet_identifier(arguments.name)
+        where["identifier"] = [] if identifier is None else identifier
 
-    content = CARFile(arguments.filepath)
     if arguments.show:
         content.dump()
         for facet in content.facets:
-            facet.dump()
+            if arguments.name in (None, facet.name):
+                facet.dump()
 
-        for rendition in content.renditions:
+        for rendition in content.iter_renditions(lazy=True,
+                                                 where=where or None):
             rendition.dump()
 
     if arguments.directory:
-        for rendition in content.renditions:
-            decoder = RenditionDecoder(rendition)
-            decoder.decode()
+        export(content, arguments.directory, arguments.jobs,
+               arguments.max_memory * 1024 * 1024, where=where)
+
+    if arguments.diff:
+        diff(content, CARFile(arguments.diff, sidecar=sidecar)).dump()
+
+    if arguments.thin:
+        try:
+            counts = thin(content, arguments.thin, **keep)
+        except CARIndexError as error:
+            parser.error("--keep: %s" % error)
+
+        print "Kept %(kept)d renditions, dropped %(dropped)d, %(shared)d " \
+            "shared payloads" % counts
+
+    try:
+        while arguments.watch:
+            time.sleep(arguments.watch)
+            changed = content.refresh()
+            if changed:
+                print "Reloaded %s: %s" % (arguments.filepath,
+                                           ", ".join(changed))
+                if arguments.show:
+                    content.dump()
+    except KeyboardInterrupt:
+        pass
 
 
 if __name__ == "__main__":
@@ -0,0 +1,212 @@
+import multiprocessing
+import os
+import sqlite3
+import struct
+import sys
+import time
+
+from itertools import imap
+
+from car import CARFile, BOMInvalidFile
+from parse import CAR_ATTRIBUTE_BY_ID
+
+
+ATTRIBUTE_COLUMNS = [CAR_ATTRIBUTE_BY_ID[i]
+                     for i in sorted(CAR_ATTRIBUTE_BY_ID)]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    uuid TEXT,
+    associated_checksum INTEGER,
+    creator TEXT,
+    storage_version INTEGER,
+    rendition_count INTEGER,
+    scanned_at REAL
+);
+CREATE TABLE IF NOT EXISTS failures (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    error TEXT,
+    scanned_at REAL
+);
+CREATE TABLE IF NOT EXISTS facets (
+    file_id INTEGER NOT NULL REFERENCES files(id),
+    name TEXT NOT NULL,
+    identifier INTEGER
+);
+CREATE TABLE IF NOT EXISTS renditions (
+    file_id INTEGER NOT NULL REFERENCES files(id),
+    name TEXT,
+    key BLOB NOT NULL,
+    layout TEXT,
+    pixel_format TEXT,
+    width INTEGER,
+    height INTEGER,
+    scale_factor INTEGER,
+    payload_size INTEGER,
+    %s
+);
+CREATE INDEX IF NOT EXISTS facets_file ON facets (file_id);
+CREATE INDEX IF NOT EXISTS facets_name ON facets (name);
+CREATE INDEX IF NOT EXISTS renditions_file ON renditions (file_id);
+CREATE INDEX IF NOT EXISTS renditions_name ON renditions (name);
+CREATE INDEX IF NOT EXISTS renditions_identifier
+    ON renditions (identifier, scale, idiom, appearance);
+""" % ",\n    ".join("%s INTEGER" % column for column in ATTRIBUTE_COLUMNS)
+
+RENDITION_COLUMNS = ["file_id", "name", "key", "layout", "pixel_format",
+                     "width", "height", "scale_factor", "payload_size"] + \
+    ATTRIBUTE_COLUMNS
+
+
+def find_car_files(directory):
+    for root, _, names in os.walk(directory):
+        for name in sorted(names):
+            if name.endswith(".car"):
+                yield os.path.abspath(os.path.join(root, name))
+
+
+def _scan_file(path):
+    """
+    Reads the metadata of a single car file. Runs on the worker processes,
+    so it only returns plain rows.
+    """
+    try:
+        stat = os.stat(path)
+        car = CARFile(path, lazy=True)
+        header = car.header
+        facets = [(facet.name, identifier) for facet, identifier in
+                  ((x, car._facet_identifier(x)) for x in car.facets)
+                  if identifier is not None]
+        renditions = []
+        for rendition in car.iter_renditions(lazy=True):
+            attributes = dict((x.identifier, value) for x, value in
+                              rendition.attributes.iteritems())
+            renditions.append(
+                [rendition.name, rendition.key,
+                 rendition.layout, rendition.pixel_format.strip(" \x00"),
+                 rendition.width, rendition.height, rendition.scale_factor,
+                 rendition.payload_size] +
+                [attributes.get(column) for column in ATTRIBUTE_COLUMNS])
+    except (BOMInvalidFile, EnvironmentError, ValueError,
+            struct.error) as error:
+        return path, None, str(error)
+
+    file_row = (path, stat.st_size, stat.st_mtime, header.uuid,
+                header.associated_checksum, header.file_creator,
+                header.storage_version, header.rendition_count, time.time())
+    return path, (file_row, facets, renditions), None
+
+
+class Catalogue(object):
+    """
+    SQLite inventory of car files: one row per file, facet and rendition,
+    with the rendition attributes as indexed columns. Files are skipped on
+    re-runs while their size and mtime are unchanged, including the ones that
+    failed to parse, which are kept in `failures`.
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.text_factory = str
+        self.connection.executescript(SCHEMA)
+
+    def is_current(self, path):
+        stat = os.stat(path)
+        for table in ("files", "failures"):
+            row = self.connection.execute(
+                "SELECT size, mtime FROM %s WHERE path = ?" % table,
+                (path,)).fetchone()
+            if row is not None and \
+                    tuple(row) == (stat.st_size, stat.st_mtime):
+                return True
+
+        return False
+
+    def store_failure(self, path, error):
+        try:
+            stat = os.stat(path)
+        except EnvironmentError:
+            return
+
+        self.connection.execute(
+            "INSERT OR REPLACE INTO failures VALUES (?, ?, ?, ?, ?)",
+            (path, stat.st_size, stat.st_mtime, error, time.time()))
+
+    def store(self, metadata):
+        file_row, facets, renditions = metadata
+        cursor = self.connection.cursor()
+        cursor.execute("DELETE FROM failures WHERE path = ?", (file_row[0],))
+        row = cursor.execute("SELECT id FROM files WHERE path = ?",
+                             (file_row[0],)).fetchone()
+        if row:
+            cursor.execute("DELETE FROM facets WHERE file_id = ?", row)
+            cursor.execute("DELETE FROM renditions WHERE file_id = ?", row)
+            cursor.execute("DELETE FROM files WHERE id = ?", row)
+
+        cursor.execute("INSERT INTO files (path, size, mtime, uuid, "
+                       "associated_checksum, creator, storage_version, "
+                       "rendition_count, scanned_at) "
+                       "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", file_row)
+        file_id = cursor.lastrowid
+        cursor.executemany("INSERT INTO facets VALUES (?, ?, ?)",
+                           [(file_id,) + facet for facet in facets])
+        cursor.executemany(
+            "INSERT INTO renditions (%s) VALUES (%s)" %
+            (", ".join(RENDITION_COLUMNS),
+             ", ".join("?" * len(RENDITION_COLUMNS))),
+            [[file_id, rendition[0], sqlite3.Binary(rendition[1])] +
+             rendition[2:] for rendition in renditions])
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+def scan(directory, catalogue_path, jobs=1, batch_size=64):
+    """
+    Scans every `.car` file under `directory` into the SQLite catalogue at
+    `catalogue_path`. Files are read on a process pool and stored by this
+    process, committing every `batch_size` files. Returns the number of
+    scanned files.
+    """
+    catalogue = Catalogue(catalogue_path)
+    paths = [path for path in find_car_files(directory)
+             if not catalogue.is_current(path)]
+
+    pool = None
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        results = pool.imap_unordered(_scan_file, paths)
+    else:
+        results = imap(_scan_file, paths)
+
+    scanned = 0
+    try:
+        for path, metadata, error in results:
+            if error:
+                print >> sys.stderr, "Skipping %s: %s" % (path, error)
+                catalogue.store_failure(path, error)
+                continue
+
+            catalogue.store(metadata)
+            scanned += 1
+            if scanned % batch_size == 0:
+                catalogue.commit()
+
+        catalogue.commit()
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+        catalogue.close()
+
+    return scanned
@@ -0,0 +1,244 @@
+import mimetypes
+import os
+import struct
+import sys
+import threading
+import time
+import urllib
+import urlparse
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from multiprocessing.pool import ThreadPool
+
+from cache import RenditionCache, DEFAULT_BUDGET
+from car import CARFile, BOMInvalidFile
+from decoders import RenditionDecoder, RenditionDecoderError, \
+                     DEFAULT_MAX_MEMORY
+from index import CARIndexError
+from scan import find_car_files
+
+
+# Query parameters used to pick a rendition of the requested facet.
+QUERY_ATTRIBUTES = ["scale", "idiom", "appearance"]
+
+
+class AssetServerError(Exception):
+    def __init__(self, status, message):
+        super(AssetServerError, self).__init__(message)
+        self.status = status
+
+
+class AssetServer(ThreadingMixIn, HTTPServer):
+    """
+    Long-lived HTTP server answering `GET /<file>/<facet>?scale=&idiom=&
+    appearance=` with the image of the matching rendition, where `<file>` is
+    the name without extension of a car file under `directory`.
+
+    Files are opened once, lazily, and shared by all request threads. Images
+    are decoded on a pool of `jobs` threads (zlib and NumPy release the GIL)
+    and concurrent requests for the same rendition wait for a single decode.
+    Decoded images are kept in a `RenditionCache` of `cache_budget` bytes.
+    With `watch` set, open files are refreshed every `watch` seconds; they
+    are then read into memory rather than mapped (see `CARFile`), so requests
+    reading the previous snapshot survive a file rewritten in place.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, directory, jobs=4,
+                 max_memory=DEFAULT_MAX_MEMORY, sidecar=None,
+                 cache_budget=DEFAULT_BUDGET, watch=None):
+        HTTPServer.__init__(self, address, AssetRequestHandler)
+        self.paths = {}
+        for path in find_car_files(directory):
+            name = os.path.splitext(os.path.basename(path))[0]
+            self.paths.setdefault(name, path)
+
+        self.max_memory = max_memory
+        self.sidecar = sidecar
+        self.mapped = not watch
+        self.cache = RenditionCache(cache_budget)
+        self.files = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.pool = ThreadPool(jobs)
+        if watch:
+            watcher = threading.Thread(target=self.watch, args=(watch,))
+            watcher.daemon = True
+            watcher.start()
+
+    def car(self, name):
+        """
+        The open `CARFile` for `name`, opened on first use.
+        """
+        if name not in self.paths:
+            raise AssetServerError(404, "Unknown file %s" % name)
+
+        with self.lock:
+            if name not in self.files:
+                self.files[name] = CARFile(self.paths[name], lazy=True,
+                                           sidecar=self.sidecar,
+                                           cache=self.cache,
+                                           mapped=self.mapped)
+
+            return self.files[name]
+
+    def refresh(self):
+        """
+        Refreshes every open file, see `CARFile.refresh`. Returns a dict of
+        file name -> changed ToC entries, for the files that changed.
+        """
+        with self.lock:
+            files = self.files.items()
+
+        changes = {}
+        for name, car in files:
+            try:
+                changed = car.refresh()
+            except (BOMInvalidFile, EnvironmentError) as error:
+                print >> sys.stderr, "Keeping %s: %s" % (name, error)
+                continue
+
+            if changed:
+                changes[name] = changed
+
+        return changes
+
+    def watch(self, interval):
+        while True:
+            time.sleep(interval)
+            for name, changed in self.refresh().iteritems():
+                print >> sys.stderr, "Reloaded %s: %s" % \
+                    (name, ", ".join(changed))
+
+    def render(self, name, facet, **attributes):
+        """
+        Returns (content type, image bytes) of the first rendition of `facet`
+        in file `name` matching `attributes`.
+        """
+        # One snapshot throughout, so the value index found is read from the
+        # blocks it was found in even if the file is refreshed meanwhile.
+        car = self.car(name).snapshot
+        try:
+            matches = car.index.find(facet, **attributes)
+        except CARIndexError as error:
+            raise AssetServerError(400, str(error))
+
+        if not matches:
+            raise AssetServerError(404, "No rendition of %s matches %s" %
+                                   (facet, attributes))
+
+        values, value_index = min(matches)
+        key = (car.identity, value_index)
+        with self.lock:
+            pending = self.pending.get(key)
+            if pending is None:
+                pending = self.pending[key] = SharedDecode()
+                self.pool.apply_async(pending.run, (
+                    car, value_index, car.index.key_layout.pack(*values),
+                    self.max_memory))
+
+        try:
+            return pending.get()
+        finally:
+            with self.lock:
+                if self.pending.get(key) is pending:
+                    del self.pending[key]
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        self.pool.close()
+        self.pool.join()
+
+
+class SharedDecode(object):
+    """
+    A decode running on the pool, waited on by every request for the same
+    rendition. (`AsyncResult.get` only wakes up one of several waiters.)
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def run(self, car, value_index, key, max_memory):
+        try:
+            self.result = _decode(car, value_index, key, max_memory)
+        except Exception as error:
+            self.error = error
+        finally:
+            self.done.set()
+
+    def get(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+
+        return self.result
+
+
+def _decode(car, value_index, key, max_memory):
+    rendition = car.cache.rendition(car, value_index, key)
+    extension = RenditionDecoder(rendition).extension
+    content_type = mimetypes.guess_type("image." + extension)[0]
+    return content_type or "application/octet-stream", \
+        car.cache.image(car, value_index, key, max_memory)
+
+
+class AssetRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        parts = [urllib.unquote(x) for x in url.path.strip("/").split("/")]
+        try:
+            if len(parts) != 2:
+                raise AssetServerError(404, "Expected /<file>/<facet>")
+
+            attributes = {}
+            for attribute, values in urlparse.parse_qs(url.query).iteritems():
+                if attribute not in QUERY_ATTRIBUTES:
+                    raise AssetServerError(400, "Unknown parameter %s" %
+                                           attribute)
+                try:
+                    attributes[attribute] = int(values[-1])
+                except ValueError:
+                    raise AssetServerError(400, "Invalid %s" % attribute)
+
+            content_type, content = self.server.render(*parts, **attributes)
+        except AssetServerError as error:
+            self.send_error(error.status, str(error))
+            return
+        except (BOMInvalidFile, RenditionDecoderError, EnvironmentError,
+                struct.error) as error:
+            self.send_error(500, str(error))
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        print >> sys.stderr, "%s - %s" % (self.address_string(),
+                                          format % args)
+
+
+def serve(directory, host="127.0.0.1", port=8000, jobs=4,
+          max_memory=DEFAULT_MAX_MEMORY, sidecar=None,
+          cache_budget=DEFAULT_BUDGET, watch=None):
+    """
+    Serves the car files under `directory` until interrupted.
+    """
+    server = AssetServer((host, port), directory, jobs, max_memory, sidecar,
+                         cache_budget, watch)
+    print "Serving %d car files on http://%s:%d/" % \
+        (len(server.paths), host, server.server_address[1])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
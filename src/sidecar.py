@@ -0,0 +1,114 @@
+import hashlib
+import marshal
+import os
+import sys
+
+from array import array
+from collections import namedtuple
+
+
+SIDECAR_MAGIC = "CARIDX"
+SIDECAR_VERSION = 1
+
+SidecarEntry = namedtuple("SidecarEntry", ("uuid", "checksum", "table",
+                                           "blocks", "facets", "keys",
+                                           "value_indexes"))
+
+
+class CARSidecar(object):
+    """
+    On-disk cache of everything `CARFile` needs before it can answer lookups:
+    the block table, the table of contents and the facet/rendition key index.
+
+    Entries are stored in a compact marshal + array sidecar file, one per car
+    file, and keyed by the file path, size and modification time. Once the
+    header is available the cached `uuid` and `associated_checksum` are
+    verified as well; any mismatch rebuilds the entry.
+    """
+
+    def __init__(self, directory=None):
+        """
+        - parameter directory: Where sidecar files are stored. Defaults to next
+                               to each car file (`<path>.idx`).
+        """
+        self.directory = directory
+
+    def path_for(self, path):
+        path = os.path.abspath(path)
+        if not self.directory:
+            return path + ".idx"
+
+        name = hashlib.sha1(path).hexdigest() + ".idx"
+        return os.path.join(self.directory, name)
+
+    def load(self, car):
+        """
+        Returns the `SidecarEntry` stored for `car`, or None when there is no
+        entry or the file changed since it was written.
+        """
+        try:
+            with open(self.path_for(car.path), "rb") as stream:
+                content = marshal.load(stream)
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+
+        if not isinstance(content, tuple) or len(content) != 4:
+            return None
+
+        magic, version, identity, entry = content
+        if (magic, version) != (SIDECAR_MAGIC, SIDECAR_VERSION):
+            return None
+
+        if identity != self._identity(car):
+            return None
+
+        uuid, checksum, table, blocks, facets, keys, value_indexes = entry
+        return SidecarEntry(uuid, checksum, table, array("I", blocks), facets,
+                            array("H", keys), array("I", value_indexes))
+
+    def save(self, car):
+        """
+        Writes the block table, ToC and key index of `car`. The sidecar is
+        replaced atomically so concurrent readers never see a partial entry.
+        The sidecar is only a cache: when it can't be written a warning is
+        printed and False is returned, the car file stays usable.
+        """
+        header = car.header
+        index = car.index
+        keys = array("H")
+        value_indexes = array("I")
+        for renditions in index.renditions.itervalues():
+            for values, value_index in renditions:
+                keys.extend(values)
+                value_indexes.append(value_index)
+
+        entry = (header.uuid, header.associated_checksum, car.table,
+                 car.blocks.entries.tostring(), index.facets, keys.tostring(),
+                 value_indexes.tostring())
+        content = (SIDECAR_MAGIC, SIDECAR_VERSION, self._identity(car), entry)
+
+        path = self.path_for(car.path)
+        temporary = "%s.%d.tmp" % (path, os.getpid())
+        try:
+            if self.directory and not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+
+            with open(temporary, "wb") as stream:
+                marshal.dump(content, stream)
+
+            os.rename(temporary, path)
+        except EnvironmentError as error:
+            print >> sys.stderr, "Not caching %s: %s" % (car.path, error)
+            try:
+                os.remove(temporary)
+            except EnvironmentError:
+                pass
+
+            return False
+
+        return True
+
+    def _identity(self, car):
+        # The file as it was read, not as it is now: an entry saved after the
+        # file changed must not pass for the new content.
+        return car.identity + (sys.byteorder,)
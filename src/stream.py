@@ -0,0 +1,62 @@
+import struct
+
+
+class BufferStream(object):
+    """
+    Read-only, file-like cursor over any object exposing the buffer interface
+    (str, mmap, buffer). Positions are absolute offsets into `data`, so a
+    stream over a memory mapped file can be used exactly like the file itself.
+
+    `read` returns a copy of the requested bytes, while `view` hands out a
+    zero-copy `buffer` slice over the same memory. Fixed size fields can be
+    decoded in place with `unpack`.
+    """
+
+    def __init__(self, data, offset=0, size=None):
+        """
+        - parameter data:   The underlying buffer (str, mmap, buffer).
+        - parameter offset: Absolute offset where the stream starts.
+        - parameter size:   Number of readable bytes from `offset`. Defaults to
+                            the rest of the buffer.
+        """
+        self.data = data
+        self.offset = offset
+        self.end = len(data) if size is None else offset + size
+
+    def tell(self):
+        return self.offset
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.offset
+        elif whence == 2:
+            offset += self.end
+
+        self.offset = offset
+
+    def read(self, size=-1):
+        start = self.offset
+        end = self.end if size < 0 else min(start + size, self.end)
+        self.offset = max(end, start)
+        return self.data[start:end]
+
+    def view(self, size):
+        """
+        Returns a zero-copy slice of `size` bytes and advances the cursor.
+        """
+        start = self.offset
+        size = max(min(size, self.end - start), 0)
+        self.offset = start + size
+        return buffer(self.data, start, size)
+
+    def unpack(self, layout):
+        """
+        Decodes a `struct.Struct` in place and advances the cursor.
+        """
+        if self.offset + layout.size > self.end:
+            raise struct.error("unpack requires %d bytes at offset %d" %
+                               (layout.size, self.offset))
+
+        values = layout.unpack_from(self.data, self.offset)
+        self.offset += layout.size
+        return values
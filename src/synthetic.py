@@ -0,0 +1,129 @@
+import random
+import struct
+import zlib
+
+from car import BLOCK_CARHEADER, BLOCK_EXTENDED_METADATA, BLOCK_FACET_KEYS, \
+                BLOCK_KEY_FORMAT, BLOCK_RENDITIONS, IDENTIFIER_ATTRIBUTE
+from writer import BOMWriter
+
+
+# appearance, idiom, scale, identifier, element, part, dimension1
+SYNTHETIC_IDENTIFIERS = [7, 15, 12, IDENTIFIER_ATTRIBUTE, 1, 2, 8]
+
+SCALES = 3
+IDIOMS = 5
+APPEARANCES = 2
+
+
+def pack_header(rendition_count, uuid="\x00" * 16):
+    return "RATC" + struct.pack("<IIII", 0x1ea, 17, 0, rendition_count) + \
+        "synthetic\n".ljust(128, "\x00") + "pycar".ljust(256, "\x00") + \
+        uuid + struct.pack("<IIII", 0, 2, 0, 2)
+
+
+def pack_key_format(identifiers):
+    return "kfmt" + struct.pack("<II", 0, len(identifiers)) + \
+        "".join(struct.pack("<I", x) for x in identifiers)
+
+
+def pack_metadata(contents="synthetic", creator="pycar"):
+    return "META" + contents.ljust(768, "\x00") + \
+        (creator + "\n").ljust(256, "\x00")
+
+
+def pack_facet(identifier, element=85):
+    attributes = [(IDENTIFIER_ATTRIBUTE, identifier), (1, element)]
+    return struct.pack("<HHH", 0, 0, len(attributes)) + \
+        "".join(struct.pack("<HH", *x) for x in attributes)
+
+
+def pack_rendition(name, width, height, scale, pixels, compress=True,
+                   layout=12, slices=None):
+    """
+    Packs a CTSI rendition holding premultiplied BGRA `pixels` (ARGB pixel
+    format) in a CELM payload, zlib compressed unless `compress` is off.
+    """
+    stride = width * 4
+    binary = zlib.compress(pixels) if compress else pixels
+    content = "MLEC" + struct.pack("<II", 0, len(binary)) + binary
+
+    slices = slices or [(0, 0, width, height)]
+    info = struct.pack("<III", 1007, 4, stride) + \
+        struct.pack("<III", 1001, 4 + 16 * len(slices), len(slices)) + \
+        "".join(struct.pack("<IIII", *x) for x in slices)
+
+    return "ISTC" + struct.pack("<IB3sIII", 1, 0, "", width, height,
+                                scale * 100) + "BGRA" + \
+        struct.pack("<B3sIHH", 0, "", 0, layout, 0) + \
+        name.ljust(128, "\x00") + \
+        struct.pack("<IIII", len(info), 1, 0, len(content)) + info + content
+
+
+def pack_link(name, width, height, scale, atlas, rect):
+    """
+    Packs an internal link rendition (no payload) whose pixels are the `rect`
+    (x, y, width, height) of the rendition keyed by `atlas`, a dict of
+    attribute identifier -> value.
+    """
+    key = "".join(struct.pack("<HH", *x) for x in sorted(atlas.iteritems()))
+    reference = "KLNI" + struct.pack("<IIIIIHH", 0, *(tuple(rect) +
+                                                       (0, len(key)))) + key
+    info = struct.pack("<II", 1010, len(reference)) + reference
+
+    return "ISTC" + struct.pack("<IB3sIII", 1, 0, "", width, height,
+                                scale * 100) + "BGRA" + \
+        struct.pack("<B3sIHH", 0, "", 0, 1003, 0) + \
+        name.ljust(128, "\x00") + \
+        struct.pack("<IIII", len(info), 0, 0, 0) + info
+
+
+def rendition_attributes(facet, variant):
+    """
+    Attribute values of the `variant`-th rendition of `facet`, following
+    `SYNTHETIC_IDENTIFIERS`. Variants cycle through scales, idioms and
+    appearances before bumping `dimension1`, so keys are always unique.
+    """
+    scale = 1 + variant % SCALES
+    idiom = (variant // SCALES) % IDIOMS
+    appearance = (variant // (SCALES * IDIOMS)) % APPEARANCES
+    dimension = variant // (SCALES * IDIOMS * APPEARANCES)
+    return (appearance, idiom, scale, facet + 1, 85, 181, dimension)
+
+
+def synthesize(path, facets=100, renditions_per_facet=3, fanout=64,
+               payload_size=4096, compress=True, seed=0):
+    """
+    Writes a valid car file with `facets` facets of `renditions_per_facet`
+    renditions each. Trees are built with the given leaf `fanout` and every
+    rendition carries a bitmap of about `payload_size` uncompressed bytes.
+    Contents are deterministic for a given `seed`.
+    """
+    generator = random.Random(seed)
+    side = max(int((payload_size // 4) ** 0.5), 1)
+    writer = BOMWriter()
+
+    facet_items = []
+    rendition_items = []
+    for facet in xrange(facets):
+        name = "facet%06d" % facet
+        facet_items.append((name, pack_facet(facet + 1)))
+        for variant in xrange(renditions_per_facet):
+            attributes = rendition_attributes(facet, variant)
+            key = struct.pack("<%dH" % len(attributes), *attributes)
+            # A few random rows repeated, compressible like real artwork.
+            row = "".join(chr(generator.randint(0, 255))
+                          for _ in xrange(side * 4))
+            pixels = row * side
+            rendition_items.append((key, pack_rendition(
+                name + ".png", side, side, attributes[2], pixels, compress)))
+
+    uuid = "".join(chr(generator.randint(0, 255)) for _ in xrange(16))
+    header = pack_header(len(rendition_items), uuid)
+    writer.name(BLOCK_CARHEADER, writer.add(header))
+    writer.name(BLOCK_KEY_FORMAT,
+                writer.add(pack_key_format(SYNTHETIC_IDENTIFIERS)))
+    writer.name(BLOCK_EXTENDED_METADATA, writer.add(pack_metadata()))
+    writer.name(BLOCK_FACET_KEYS, writer.add_tree(facet_items, fanout))
+    writer.name(BLOCK_RENDITIONS, writer.add_tree(rendition_items, fanout))
+    writer.write(path)
+    return path
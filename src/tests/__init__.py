@@ -0,0 +1,40 @@
+import shutil
+import tempfile
+import unittest
+
+from models import Model
+
+
+class TemporaryDirectoryTestCase(unittest.TestCase):
+    """
+    Test case writing its files (synthetic car files, sidecars, exports...)
+    into a fresh `directory`, removed after each test.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="pycar-")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, True)
+
+
+def state(value):
+    """
+    Comparable (and hashable) form of a parsed model: its class and fields,
+    nested models included, with lazy fields resolved (see
+    `Model.__getstate__`). `metadata_size` counts the bytes parsed upfront,
+    which lazy models don't, and is left out.
+    """
+    if isinstance(value, Model):
+        fields = value.__getstate__()
+        fields.pop("metadata_size", None)
+        return type(value).__name__, state(fields)
+
+    if isinstance(value, (list, tuple)):
+        return tuple(state(x) for x in value)
+
+    if isinstance(value, dict):
+        return tuple(sorted((state(key), state(field))
+                            for key, field in value.iteritems()))
+
+    return value
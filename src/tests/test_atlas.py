@@ -0,0 +1,150 @@
+import os
+import struct
+import unittest
+
+import atlas
+import pixels as vectorised
+
+from atlas import AtlasCache
+from cache import RenditionCache
+from car import CARFile, BLOCK_CARHEADER, BLOCK_FACET_KEYS, \
+                BLOCK_KEY_FORMAT, BLOCK_RENDITIONS
+from export import export
+from synthetic import pack_header, pack_key_format, pack_facet, \
+                      pack_rendition, pack_link, SYNTHETIC_IDENTIFIERS
+from tests import TemporaryDirectoryTestCase
+from tests.test_decoders import opaque
+from writer import BOMWriter
+
+
+ATLAS_SIZE = 32
+TILE = 8
+
+
+def pack_atlases(path, atlases):
+    """
+    Writes a car file with one facet per atlas (`atlas<n>`) and one internal
+    link per `TILE` square of it (`icon<n>_<tile>`), tiles in rows from the
+    top left.
+    """
+    writer = BOMWriter()
+    facets = []
+    renditions = []
+    identifier = 1
+    for number, pixels in enumerate(atlases):
+        facets.append(("atlas%d" % number, pack_facet(identifier)))
+        key = (0, 0, 1, identifier, 85, 181, 0)
+        renditions.append((struct.pack("<7H", *key), pack_rendition(
+            "atlas%d.png" % number, ATLAS_SIZE, ATLAS_SIZE, 1,
+            pixels[..., [2, 1, 0, 3]].tostring())))
+        atlas = dict(zip(SYNTHETIC_IDENTIFIERS, key))
+        identifier += 1
+
+        tiles = ATLAS_SIZE // TILE
+        for tile in range(tiles * tiles):
+            name = "icon%d_%d" % (number, tile)
+            rect = (tile % tiles * TILE, tile // tiles * TILE, TILE, TILE)
+            facets.append((name, pack_facet(identifier)))
+            renditions.append((
+                struct.pack("<7H", 0, 0, 1, identifier, 85, 181, 0),
+                pack_link(name + ".png", TILE, TILE, 1, atlas, rect)))
+            identifier += 1
+
+    writer.name(BLOCK_CARHEADER, writer.add(pack_header(len(renditions))))
+    writer.name(BLOCK_KEY_FORMAT,
+                writer.add(pack_key_format(SYNTHETIC_IDENTIFIERS)))
+    writer.name(BLOCK_FACET_KEYS, writer.add_tree(facets))
+    writer.name(BLOCK_RENDITIONS, writer.add_tree(renditions))
+    writer.write(path)
+    return path
+
+
+@unittest.skipUnless(vectorised.available, "NumPy is required")
+class AtlasCacheTest(TemporaryDirectoryTestCase):
+    def setUp(self):
+        super(AtlasCacheTest, self).setUp()
+        self.atlases = [opaque(ATLAS_SIZE, ATLAS_SIZE, seed) for seed in
+                        range(3)]
+        self.path = pack_atlases(os.path.join(self.directory, "p.car"),
+                                 self.atlases)
+        self.car = CARFile(self.path, lazy=True)
+
+    def links(self, car=None):
+        return [x for x in (car or self.car).iter_renditions()
+                if x.reference is not None]
+
+    def test_crops(self):
+        link = self.car.lookup("icon1_6")[0]
+        self.assertEqual((link.reference.x, link.reference.y), (16, 8))
+
+        crop = self.car.atlases.pixels(link)
+        self.assertEqual(crop.shape, (TILE, TILE, 4))
+        self.assertTrue((crop == self.atlases[1][8:16, 16:24]).all())
+        # A view over the atlas, not a copy.
+        self.assertIsNotNone(crop.base)
+        self.assertTrue((self.car.pixels(link) == crop).all())
+
+    def test_atlases_decoded_once(self):
+        links = self.links()
+        self.assertEqual(len(links), 48)
+        atlases = self.car.atlases
+        for link in links:
+            atlases.pixels(link)
+        self.assertEqual(atlases.decodes, 3)
+
+    def test_planned_atlases_dropped_after_last_crop(self):
+        atlases = AtlasCache(self.car)
+        links = self.links()
+        atlases.plan(links)
+        for link in links[:-1]:
+            atlases.pixels(link)
+        self.assertEqual(len(atlases), 1)
+
+        atlases.pixels(links[-1])
+        self.assertEqual(len(atlases), 0)
+        self.assertEqual(atlases.evictions, 3)
+
+    def test_unplanned_atlases_within_budget(self):
+        size = ATLAS_SIZE * ATLAS_SIZE * 4
+        atlases = AtlasCache(self.car, budget=size)
+        for link in self.links():
+            atlases.pixels(link)
+        self.assertEqual(atlases.decodes, 3)
+        self.assertEqual(atlases.cache.stats()["size"], size)
+
+    def test_shared_cache(self):
+        cache = RenditionCache()
+        car = CARFile(self.path, lazy=True, cache=cache)
+        index = car.index
+        values, value_index = index.find("icon2_3")[0]
+        image = cache.image(car, value_index, index.key_layout.pack(*values))
+        self.assertEqual(image[:8], "\x89PNG\r\n\x1a\n")
+        self.assertIs(car.atlases.cache, cache)
+
+    def test_export(self):
+        output = os.path.join(self.directory, "export")
+        paths = export(self.car, output)
+        self.assertEqual(len(paths), 51)
+        self.assertEqual(sorted(os.listdir(output)),
+                         sorted(os.path.basename(x) for x in paths))
+        self.assertEqual(self.car.atlases.decodes, 3)
+        self.assertEqual(len(self.car.atlases), 0)
+
+    def test_export_max_memory(self):
+        # Atlases are decoded within the ceiling given to the export.
+        ceilings = []
+
+        class RenditionDecoder(atlas.RenditionDecoder):
+            def __init__(self, rendition, max_memory):
+                ceilings.append(max_memory)
+                super(RenditionDecoder, self).__init__(rendition, max_memory)
+
+        decoder, atlas.RenditionDecoder = atlas.RenditionDecoder, \
+            RenditionDecoder
+        try:
+            export(self.car, os.path.join(self.directory, "export"),
+                   max_memory=1024)
+        finally:
+            atlas.RenditionDecoder = decoder
+
+        self.assertEqual(ceilings, [1024] * 3)
@@ -0,0 +1,45 @@
+import struct
+import unittest
+
+from bom_models import BOMBlockTable, BlockEntry
+from stream import BufferStream
+
+
+def block_table(blocks):
+    return BOMBlockTable.make(BufferStream(
+        struct.pack(">I", len(blocks)) +
+        "".join(struct.pack(">II", *x) for x in blocks)))
+
+
+class BOMBlockTableTest(unittest.TestCase):
+    def setUp(self):
+        self.blocks = [(i * 16, 16 + i % 3) for i in range(40)]
+        self.table = block_table(self.blocks)
+
+    def test_make(self):
+        table = self.table
+        self.assertEqual(len(table), 40)
+        self.assertEqual(table[7], BlockEntry(112, 17))
+        self.assertEqual(table[7].index, 112)
+        self.assertEqual(list(table), [BlockEntry(*x) for x in self.blocks])
+
+    def test_truncated(self):
+        self.assertRaises(ValueError, BOMBlockTable.make, BufferStream(
+            struct.pack(">III", 2, 0, 16)))
+
+    def test_changes(self):
+        self.assertEqual(self.table.changes(block_table(self.blocks)), [])
+
+        blocks = list(self.blocks)
+        blocks[3] = (48, 99)
+        blocks[30] = (1024, 18)
+        other = block_table(blocks)
+        # Whole unchanged chunks are skipped, whatever their size.
+        for chunk in (2, 6, 4096):
+            self.assertEqual(self.table.changes(other, chunk), [3, 30])
+
+    def test_changes_in_length(self):
+        longer = block_table(self.blocks + [(640, 4), (644, 4)])
+        self.assertEqual(self.table.changes(longer), [40, 41])
+        self.assertEqual(longer.changes(self.table), [40, 41])
+        self.assertEqual(self.table.changes(block_table([])), range(40))
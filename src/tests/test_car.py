@@ -0,0 +1,312 @@
+import os
+import pickle
+import shutil
+import struct
+import time
+
+from bom_models import BOMTree
+from car import CARFile, BLOCK_BITMAP_KEYS, BLOCK_CARHEADER, BLOCK_COLORS, \
+                BLOCK_ELEMENT_INFO, BLOCK_EXTERNAL_KEYS, BLOCK_FACET_KEYS, \
+                BLOCK_KEY_FORMAT, BLOCK_PART_INFO, BLOCK_RENDITIONS
+from sidecar import CARSidecar
+from synthetic import synthesize, pack_header, pack_key_format, \
+                      pack_facet, pack_rendition, rendition_attributes, \
+                      SYNTHETIC_IDENTIFIERS
+from tests import TemporaryDirectoryTestCase, state
+from writer import BOMWriter
+
+
+FACETS = 12
+RENDITIONS_PER_FACET = 4
+
+
+class CARFileTest(TemporaryDirectoryTestCase):
+    def setUp(self):
+        super(CARFileTest, self).setUp()
+        self.path = synthesize(os.path.join(self.directory, "a.car"), FACETS,
+                               RENDITIONS_PER_FACET, fanout=4,
+                               payload_size=256, seed=1)
+        self.car = CARFile(self.path)
+
+    def test_header(self):
+        self.assertEqual(self.car.header.magic, "RATC")
+        self.assertEqual(self.car.header.rendition_count,
+                         FACETS * RENDITIONS_PER_FACET)
+
+    def test_lookup(self):
+        renditions = self.car.lookup("facet000003", scale=2)
+        self.assertEqual(len(renditions), 1)
+        rendition = renditions[0]
+        self.assertEqual(rendition.name, "facet000003.png")
+        attributes = dict((x.identifier, value) for x, value in
+                          rendition.attributes.iteritems())
+        self.assertEqual(attributes["scale"], 2)
+        self.assertEqual(attributes["identifier"], 4)
+        self.assertEqual(len(self.car.lookup("facet000003")),
+                         RENDITIONS_PER_FACET)
+        self.assertEqual(self.car.lookup("missing"), [])
+
+    def test_rendition_for_key(self):
+        values = rendition_attributes(5, 2)
+        rendition = self.car.rendition_for_key(values)
+        self.assertEqual(rendition.name, "facet000005.png")
+        self.assertEqual(rendition.key, struct.pack("<7H", *values))
+        self.assertIsNone(self.car.rendition_for_key((9,) * len(values)))
+
+    def test_facet_identifier(self):
+        # Binary search before the index is built, hash lookup after.
+        self.assertEqual(self.car.facet_identifier("facet000007"), 8)
+        self.assertIsNone(self.car.facet_identifier("missing"))
+        self.car.index
+        self.assertEqual(self.car.facet_identifier("facet000007"), 8)
+
+    def test_tree_get_and_range(self):
+        tree = BOMTree.make(self.car._stream_named(BLOCK_RENDITIONS).stream)
+        stream_index = self.car._stream_index
+        items = [(key, str(value)) for key, value in
+                 tree.iterate(stream_index)]
+        keys = [key for key, _ in items]
+        self.assertEqual(len(items), FACETS * RENDITIONS_PER_FACET)
+        self.assertEqual(keys, sorted(keys))
+
+        for key, value in items:
+            self.assertEqual(str(tree.get(stream_index, key)), value)
+        self.assertIsNone(tree.get(stream_index, "\xff" * len(keys[0])))
+
+        lo, hi = keys[5], keys[20]
+        self.assertEqual([key for key, _ in tree.range(stream_index, lo, hi)],
+                         keys[5:20])
+        self.assertEqual([key for key, _ in tree.range(stream_index, lo)],
+                         keys[5:])
+        self.assertEqual([key for key, _ in
+                          tree.range(stream_index, hi=keys[3])], keys[:3])
+
+    def test_lazy_renditions_match_eager_ones(self):
+        eager = list(self.car.iter_renditions(lazy=False))
+        lazy = list(self.car.iter_renditions(lazy=True))
+        self.assertEqual(len(eager), FACETS * RENDITIONS_PER_FACET)
+        for a, b in zip(eager, lazy):
+            self.assertEqual(state(a), state(b))
+
+    def test_where(self):
+        where = {"scale": 2, "idiom": [0, 1]}
+        expected = [x.key for x in self.car.iter_renditions()
+                    if _attribute(x, "scale") == 2 and
+                    _attribute(x, "idiom") in (0, 1)]
+        self.assertTrue(expected)
+        self.assertEqual([x.key for x in
+                          self.car.iter_renditions(where=where)], expected)
+        self.assertEqual(
+            [x.key for x in self.car.iter_renditions(
+                where=lambda x: x["scale"] == 2 and x["idiom"] < 2)],
+            expected)
+
+    def test_rendition_table(self):
+        table = self.car.rendition_table
+        self.assertEqual(len(table), FACETS * RENDITIONS_PER_FACET)
+        renditions = table.select(table.where(scale=3))
+        self.assertEqual(sorted(x.key for x in renditions),
+                         sorted(x.key for x in self.car.iter_renditions(
+                             where={"scale": 3})))
+
+    def test_pickle(self):
+        rendition = self.car.lookup("facet000001", scale=1)[0]
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            copy = pickle.loads(pickle.dumps(rendition, protocol))
+            self.assertEqual(state(copy), state(rendition))
+
+
+class RefreshTest(TemporaryDirectoryTestCase):
+    def setUp(self):
+        super(RefreshTest, self).setUp()
+        self.path = os.path.join(self.directory, "a.car")
+        synthesize(self.path, 8, 3, fanout=4, payload_size=64, seed=1)
+        self.car = CARFile(self.path, lazy=True)
+        self.car.index
+
+    def touch(self, seconds):
+        os.utime(self.path, (time.time() + seconds,) * 2)
+
+    def test_unchanged(self):
+        self.assertEqual(self.car.refresh(), [])
+
+    def test_replaced(self):
+        snapshot = self.car.snapshot
+        name = "facet000002"
+        values, value_index = snapshot.index.find(name)[0]
+
+        other = synthesize(os.path.join(self.directory, "b.car"), 20, 2,
+                           fanout=4, payload_size=64, seed=2)
+        os.rename(other, self.path)
+        self.touch(5)
+        changed = self.car.refresh()
+        self.assertIn(BLOCK_FACET_KEYS, changed)
+        self.assertIn(BLOCK_RENDITIONS, changed)
+        self.assertEqual(len(self.car.index.facets), 20)
+        self.assertEqual(len(self.car.lookup(name)), 2)
+
+        # The previous snapshot keeps resolving its own value indexes.
+        self.assertIsNot(self.car.snapshot, snapshot)
+        self.assertEqual(len(snapshot.index.facets), 8)
+        key = snapshot.index.key_layout.pack(*values)
+        self.assertEqual(snapshot.rendition_at(value_index, key).name,
+                         name + ".png")
+
+    def test_rewritten_in_place_when_not_mapped(self):
+        car = CARFile(self.path, lazy=True, mapped=False)
+        snapshot = car.snapshot
+        name = "facet000002"
+        values, value_index = snapshot.index.find(name)[0]
+
+        other = synthesize(os.path.join(self.directory, "b.car"), 2, 1,
+                           fanout=4, payload_size=64, seed=2)
+        with open(other, "rb") as stream:
+            content = stream.read()
+        self.assertLess(len(content), os.path.getsize(self.path))
+        with open(self.path, "wb") as stream:
+            stream.write(content)
+        self.touch(5)
+
+        self.assertIn(BLOCK_RENDITIONS, car.refresh())
+        self.assertEqual(len(car.index.facets), 2)
+        self.assertEqual(car.lookup(name), [])
+
+        # The previous snapshot kept the bytes it was read from.
+        key = snapshot.index.key_layout.pack(*values)
+        self.assertEqual(snapshot.rendition_at(value_index, key).name,
+                         name + ".png")
+        self.assertEqual(len(snapshot.lookup("facet000007")), 3)
+
+    def edit_scale(self, name, scale, edited):
+        """
+        Overwrites in place the scale in the key of the rendition of the
+        facet `name` at `scale`.
+        """
+        index = self.car.index
+        values, _ = index.find(name, scale=scale)[0]
+        key = index.key_layout.pack(*values)
+        values = list(values)
+        values[[x.identifier for x in index.identifiers].index("scale")] = \
+            edited
+
+        with open(self.path, "r+b") as stream:
+            content = stream.read()
+            self.assertEqual(content.count(key), 1)
+            stream.seek(content.index(key))
+            stream.write(index.key_layout.pack(*values))
+        self.touch(5)
+
+    def test_key_edited_in_place(self):
+        self.edit_scale("facet000004", 1, 7)
+        self.assertEqual(self.car.refresh(), [BLOCK_RENDITIONS])
+        self.assertEqual(len(self.car.lookup("facet000004", scale=7)), 1)
+        self.assertEqual(self.car.lookup("facet000004", scale=1), [])
+
+    def test_key_edited_in_place_after_sidecar(self):
+        sidecar = CARSidecar(os.path.join(self.directory, "sidecars"))
+        CARFile(self.path, sidecar=sidecar)
+        self.car = CARFile(self.path, lazy=True, sidecar=sidecar)
+        # Restored from the sidecar, with no record of the blocks read.
+        self.assertIn("index", self.car.snapshot.__dict__)
+
+        self.edit_scale("facet000004", 1, 7)
+        self.assertIn(BLOCK_RENDITIONS, self.car.refresh())
+        self.assertEqual(len(self.car.lookup("facet000004", scale=7)), 1)
+        self.assertEqual(self.car.lookup("facet000004", scale=1), [])
+
+        # The sidecar saved with the new identity holds the new keys.
+        car = CARFile(self.path, lazy=True, sidecar=sidecar)
+        self.assertEqual(car.index.renditions, self.car.index.renditions)
+        self.assertEqual(len(car.lookup("facet000004", scale=7)), 1)
+
+    def test_header_edited_in_place(self):
+        with open(self.path, "r+b") as stream:
+            content = stream.read()
+            stream.seek(content.index("synthetic"))
+            stream.write("S")
+        self.touch(5)
+
+        self.assertEqual(self.car.refresh(), ["CARHEADER"])
+        self.assertTrue(self.car.header.file_creator.startswith("Synthetic"))
+
+    def test_copy_keeps_indexes(self):
+        copy = os.path.join(self.directory, "copy.car")
+        shutil.copy(self.path, copy)
+        os.rename(copy, self.path)
+        self.touch(5)
+        self.assertEqual(self.car.refresh(), [])
+        self.assertEqual(len(self.car.lookup("facet000001")), 3)
+
+
+class LookupTableTest(TemporaryDirectoryTestCase):
+    def setUp(self):
+        super(LookupTableTest, self).setUp()
+        self.path = os.path.join(self.directory, "l.car")
+        writer = BOMWriter()
+        writer.name(BLOCK_CARHEADER, writer.add(pack_header(1)))
+        writer.name(BLOCK_KEY_FORMAT,
+                    writer.add(pack_key_format(SYNTHETIC_IDENTIFIERS)))
+        writer.name(BLOCK_FACET_KEYS, writer.add_tree(
+            [("facet", pack_facet(1))]))
+        writer.name(BLOCK_RENDITIONS, writer.add_tree(
+            [(struct.pack("<7H", *rendition_attributes(0, 0)),
+              pack_rendition("facet.png", 2, 2, 1, "\xff" * 16))]))
+        writer.name(BLOCK_ELEMENT_INFO, writer.add_tree(
+            [("Named Element", struct.pack("<I", 85))]))
+        writer.name(BLOCK_PART_INFO, writer.add_tree(
+            [("Image", struct.pack("<I", 181)),
+             ("Color", struct.pack("<I", 218))]))
+        # Version then blue, green, red and alpha; names are padded.
+        writer.name(BLOCK_COLORS, writer.add_tree(
+            [("Accent\x00\x00", struct.pack("<I4B", 1, 10, 20, 30, 255)),
+             ("Shadow", struct.pack("<I4B", 1, 0, 0, 0, 128))]))
+        # Facet identifier -> attribute (identifier, value) pairs.
+        writer.name(BLOCK_BITMAP_KEYS, writer.add_tree(
+            [(struct.pack("<I", 1),
+              struct.pack("<II4H", 1, 2, 12, 1, 15, 0))]))
+        writer.name(BLOCK_EXTERNAL_KEYS, writer.add_tree(
+            [(struct.pack("<7H", 0, 0, 2, 9, 85, 181, 0), "external")]))
+        writer.write(self.path)
+        self.car = CARFile(self.path)
+
+    def test_lookups(self):
+        car = self.car
+        self.assertEqual(car.element_names, {85: "Named Element"})
+        self.assertEqual(car.part_names, {181: "Image", 218: "Color"})
+        self.assertEqual(car.colors, {"Accent": (30, 20, 10, 255),
+                                      "Shadow": (0, 0, 0, 128)})
+        self.assertEqual(car.bitmap_keys, {1: {12: 1, 15: 0}})
+        self.assertEqual(dict((key, str(value)) for key, value in
+                              car.external_keys.iteritems()),
+                         {(0, 0, 2, 9, 85, 181, 0): "external"})
+        # Built once.
+        self.assertIs(car.colors, car.colors)
+
+    def test_missing_blocks(self):
+        path = synthesize(os.path.join(self.directory, "a.car"), 2, 1,
+                          fanout=4, payload_size=64, seed=1)
+        car = CARFile(path)
+        for name in ("element_names", "part_names", "colors", "bitmap_keys",
+                     "external_keys"):
+            self.assertEqual(getattr(car, name), {}, name)
+
+    def test_refresh_drops_edited_table(self):
+        part_names = self.car.part_names
+        self.assertEqual(self.car.colors["Accent"], (30, 20, 10, 255))
+        with open(self.path, "r+b") as stream:
+            content = stream.read()
+            color = struct.pack("<I4B", 1, 10, 20, 30, 255)
+            self.assertEqual(content.count(color), 1)
+            stream.seek(content.index(color))
+            stream.write(struct.pack("<I4B", 1, 10, 20, 40, 255))
+        os.utime(self.path, (time.time() + 5,) * 2)
+
+        self.assertEqual(self.car.refresh(), [BLOCK_COLORS])
+        self.assertEqual(self.car.colors["Accent"], (40, 20, 10, 255))
+        self.assertIs(self.car.part_names, part_names)
+
+
+def _attribute(rendition, name):
+    for identifier, value in rendition.attributes.iteritems():
+        if identifier.identifier == name:
+            return value
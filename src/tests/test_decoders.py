@@ -0,0 +1,203 @@
+import os
+import subprocess
+import sys
+import unittest
+import zlib
+
+import pixels as vectorised
+
+from composite import composite, CompositeError
+from decoders import RenditionDecoder, RenditionDecoderError, \
+                     PIXEL_FORMATS
+from models import CARRendition
+from stream import BufferStream
+from synthetic import pack_rendition
+
+
+# Prints how much the peak RSS grows, in bytes, while writing the PNG of a
+# square ARGB rendition of argv[1] pixels with a max_memory of argv[2] MB.
+PEAK_MEMORY_SCRIPT = """
+import sys, zlib
+from decoders import RenditionDecoder
+from models import CARRendition
+from stream import BufferStream
+from synthetic import pack_rendition
+
+size, max_memory = int(sys.argv[1]), int(sys.argv[2]) << 20
+row = "".join(chr(x % 128) + chr(x % 7) + chr(x % 13) + chr(128)
+              for x in range(size))
+compressor = zlib.compressobj()
+binary = "".join(compressor.compress(row) for _ in range(size)) + \\
+    compressor.flush()
+rendition = CARRendition.make(BufferStream(pack_rendition(
+    "image.png", size, size, 1, binary, compress=False)))
+
+class Discard(object):
+    def write(self, data):
+        pass
+
+def peak():
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+
+before = peak()
+RenditionDecoder(rendition, max_memory).write(Discard())
+print peak() - before
+"""
+
+
+def opaque(height, width, seed=0):
+    """
+    Random straight alpha RGBA pixels, fully opaque so they survive the
+    premultiplication round trip exactly. Channels only take four values,
+    so payloads compress like real artwork.
+    """
+    numpy = vectorised.numpy
+    pixels = numpy.random.RandomState(seed).randint(
+        0, 4, (height, width, 4)).astype(numpy.uint8) * 85
+    pixels[..., 3] = 255
+    return pixels
+
+
+def rendition(pixels, compress=True, **options):
+    height, width = pixels.shape[:2]
+    bgra = pixels[..., [2, 1, 0, 3]].tostring()
+    return CARRendition.make(BufferStream(pack_rendition(
+        "image.png", width, height, 1, bgra, compress, **options)))
+
+
+@unittest.skipUnless(vectorised.available, "NumPy is required")
+class RenditionDecoderTest(unittest.TestCase):
+    def test_pixels(self):
+        source = opaque(10, 7)
+        for compress in (True, False):
+            decoded = RenditionDecoder(rendition(source, compress)).pixels()
+            self.assertEqual(decoded.shape, (10, 7, 4))
+            self.assertTrue((decoded == source).all())
+
+    def test_pixels_in_bands(self):
+        # Room for about one row per band.
+        source = opaque(10, 7)
+        decoder = RenditionDecoder(rendition(source), max_memory=100)
+        self.assertEqual(decoder._layout(4), (28, 1))
+        self.assertTrue((decoder.pixels() == source).all())
+
+    def test_layout_within_max_memory(self):
+        decoder = RenditionDecoder(rendition(opaque(300, 200)),
+                                   max_memory=1 << 20)
+        stride, band_rows = decoder._layout(4)
+        # Three copies of the payload rows and the converted pixels, with
+        # the temporaries of the conversion.
+        row = stride * 3 + 200 * vectorised.WORKING_BYTES_PER_PIXEL["ARGB"]
+        self.assertEqual(band_rows, (1 << 20) // row)
+
+    @unittest.skipUnless(os.path.exists("/proc/self/status"),
+                         "Reads the peak RSS from /proc")
+    def test_peak_memory(self):
+        # Decoded in a fresh process so its peak RSS only grows with the
+        # decoding. 2048x2048 ARGB with partial alpha is 16 MB of pixels.
+        growth = int(subprocess.check_output(
+            [sys.executable, "-c", PEAK_MEMORY_SCRIPT, "2048", "8"],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+        # zlib streams and pending IDAT chunks come on top of the bands.
+        self.assertLess(growth, (8 + 1) << 20)
+
+    def test_png(self):
+        content = RenditionDecoder(rendition(opaque(3, 3))).decode()
+        self.assertEqual(content[:8], "\x89PNG\r\n\x1a\n")
+
+    def test_bands_ignore_trailing_bytes(self):
+        decoder = RenditionDecoder(rendition(opaque(1, 1)))
+        payload = "".join(chr(x) for x in range(40)) + "trailing"
+        bands = list(decoder.bands(zlib.compress(payload), 4, 10, 3))
+        self.assertEqual([len(x) for x in bands], [12, 12, 12, 4])
+        self.assertEqual("".join(str(x) for x in bands), payload[:40])
+
+    def test_truncated_payload(self):
+        decoder = RenditionDecoder(rendition(opaque(1, 1)))
+        bands = decoder.bands(zlib.compress("\x00" * 30), 4, 10, 3)
+        self.assertRaises(RenditionDecoderError, list, bands)
+
+    def test_invalid_compression(self):
+        decoder = RenditionDecoder(rendition(opaque(1, 1)))
+        bands = decoder.bands("not zlib" * 4, 4, 10, 3)
+        self.assertRaises(RenditionDecoderError, list, bands)
+
+
+@unittest.skipUnless(vectorised.available, "NumPy is required")
+class ConverterTest(unittest.TestCase):
+    def test_vectorised_converters_match_row_converters(self):
+        # Random bytes cover partial, zero and full alpha; rows are padded.
+        width, height, padding = 9, 5, 3
+        random = vectorised.numpy.random.RandomState(0)
+        for pixel_format, (bpp, convert, _) in PIXEL_FORMATS.iteritems():
+            stride = width * bpp + padding
+            data = random.randint(0, 256, stride * height).astype(
+                vectorised.numpy.uint8).tostring()
+            image = vectorised.convert(data, width, height, stride,
+                                       pixel_format)
+            for y in range(height):
+                row = convert(buffer(data, y * stride, stride), width)
+                self.assertEqual(image[y].tostring(), str(row),
+                                 "%s row %d" % (pixel_format, y))
+
+    def test_png_without_numpy(self):
+        pixels = opaque(6, 5)
+        pixels[2:4, ..., 3] = 128
+        decoded = RenditionDecoder(rendition(pixels)).decode()
+        vectorised.available = False
+        try:
+            self.assertEqual(RenditionDecoder(rendition(pixels)).decode(),
+                             decoded)
+        finally:
+            vectorised.available = True
+
+
+@unittest.skipUnless(vectorised.available, "NumPy is required")
+class CompositeTest(unittest.TestCase):
+    NINE_SLICES = [(0, 0, 3, 2), (3, 0, 6, 2), (9, 0, 3, 2),
+                   (0, 2, 3, 4), (3, 2, 6, 4), (9, 2, 3, 4),
+                   (0, 6, 3, 3), (3, 6, 6, 3), (9, 6, 3, 3)]
+
+    def setUp(self):
+        self.source = opaque(9, 12)
+
+    def test_native_size(self):
+        three = [(0, 0, 3, 9), (3, 0, 6, 9), (9, 0, 3, 9)]
+        for layout, slices in ((12, None), (20, three), (21, three),
+                               (30, self.NINE_SLICES),
+                               (31, self.NINE_SLICES)):
+            image, = composite(rendition(self.source, layout=layout,
+                                         slices=slices), [(12, 9)])
+            self.assertTrue((image == self.source).all(), layout)
+
+    def test_caps_keep_their_size(self):
+        images = composite(rendition(self.source, layout=31,
+                                     slices=self.NINE_SLICES),
+                           [(30, 20), (30, 40)])
+        self.assertEqual([x.shape for x in images],
+                         [(20, 30, 4), (40, 30, 4)])
+        for image in images:
+            height = image.shape[0]
+            self.assertTrue((image[:2, :3] == self.source[:2, :3]).all())
+            self.assertTrue((image[height - 3:, 27:] ==
+                             self.source[6:, 9:]).all())
+
+    def test_tiled_center(self):
+        image, = composite(rendition(self.source, layout=30,
+                                     slices=self.NINE_SLICES), [(21, 9)])
+        # Center columns 3..8 repeat after the left cap.
+        self.assertTrue((image[:, 9:15] == self.source[:, 3:9]).all())
+        self.assertTrue((image[:, 18:] == self.source[:, 9:]).all())
+
+    def test_edges_only(self):
+        image, = composite(rendition(self.source, layout=34,
+                                     slices=self.NINE_SLICES), [(20, 15)])
+        self.assertTrue((image[2:12, 3:17] == 0).all())
+        self.assertTrue((image[:2, :3] == self.source[:2, :3]).all())
+
+    def test_fixed_size_rejected(self):
+        self.assertRaises(CompositeError, composite,
+                          rendition(self.source, layout=10), [(12, 9)])
@@ -0,0 +1,55 @@
+import os
+
+from car import CARFile, BLOCK_CARHEADER
+from diff import diff, CARDiffError
+from synthetic import synthesize
+from tests import TemporaryDirectoryTestCase
+from thin import thin
+
+
+class DiffTest(TemporaryDirectoryTestCase):
+    def setUp(self):
+        super(DiffTest, self).setUp()
+        self.path = synthesize(os.path.join(self.directory, "a.car"), 10, 3,
+                               fanout=4, payload_size=64, seed=1)
+        self.car = CARFile(self.path)
+
+    def test_identical(self):
+        result = diff(self.car, CARFile(self.path))
+        self.assertEqual(len(result), 0)
+
+    def test_thinned(self):
+        output = os.path.join(self.directory, "thin.car")
+        thin(self.car, output, scale=[1, 2])
+        result = diff(self.car, CARFile(output))
+
+        self.assertEqual(result.changed, [BLOCK_CARHEADER])
+        self.assertEqual(result.added, [])
+        self.assertEqual(result.removed, [])
+        self.assertEqual(len(result.facets), 0)
+        removed = [x.key for x in self.car.iter_renditions(
+            where={"scale": 3})]
+        self.assertEqual(sorted(result.renditions.removed), sorted(removed))
+        self.assertEqual(result.renditions.added, [])
+        self.assertEqual(result.renditions.changed, [])
+
+    def test_changed_values(self):
+        other = synthesize(os.path.join(self.directory, "b.car"), 12, 3,
+                           fanout=4, payload_size=64, seed=2)
+        result = diff(self.car, CARFile(other))
+
+        self.assertEqual(len(result.facets.added), 2)
+        self.assertEqual(len(result.renditions.added), 6)
+        # Same keys, payloads from another seed.
+        self.assertEqual(len(result.renditions.changed), 30)
+        self.assertEqual(result.renditions.removed, [])
+
+    def test_key_formats_must_match(self):
+        with open(self.path, "rb") as stream:
+            content = stream.read()
+        other = os.path.join(self.directory, "b.car")
+        with open(other, "wb") as stream:
+            # Swap two identifiers of the key format.
+            stream.write(content.replace("\x07\x00\x00\x00\x0f\x00\x00\x00",
+                                         "\x0f\x00\x00\x00\x07\x00\x00\x00"))
+        self.assertRaises(CARDiffError, diff, self.car, CARFile(other))
@@ -0,0 +1,54 @@
+import os
+import sys
+from StringIO import StringIO
+
+import instrument
+from car import CARFile
+from synthetic import synthesize
+from tests import TemporaryDirectoryTestCase
+
+
+class ProfileTest(TemporaryDirectoryTestCase):
+    def setUp(self):
+        super(ProfileTest, self).setUp()
+        self.path = synthesize(os.path.join(self.directory, "a.car"), 6, 3,
+                               fanout=4, payload_size=64, seed=1)
+
+    def tearDown(self):
+        instrument.disable()
+        super(ProfileTest, self).tearDown()
+
+    def test_counters(self):
+        profile = instrument.enable()
+        self.assertIs(instrument.active, profile)
+        renditions = list(CARFile(self.path).iter_renditions())
+        self.assertIs(instrument.disable(), profile)
+        self.assertIsNone(instrument.active)
+
+        self.assertEqual(len(renditions), 18)
+        self.assertEqual(profile.records["CARRendition"][0], 18)
+        self.assertGreaterEqual(profile.entries, 18)
+        self.assertGreater(profile.leaves, 2)
+        self.assertGreater(profile.blocks, profile.leaves)
+        self.assertGreaterEqual(profile.bytes,
+                                sum(x.metadata_size for x in renditions))
+        self.assertTrue(any(x.startswith("CARRendition.") for x in
+                            profile.fields))
+
+        # Nothing is counted once disabled.
+        list(CARFile(self.path).iter_renditions())
+        self.assertEqual(profile.records["CARRendition"][0], 18)
+
+    def test_dump(self):
+        profile = instrument.enable()
+        CARFile(self.path).lookup("facet000001")
+        instrument.disable()
+
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            profile.dump()
+        finally:
+            output, sys.stdout = sys.stdout.getvalue(), stdout
+
+        self.assertIn("Blocks read: %d" % profile.blocks, output)
+        self.assertIn("CARRendition", output)
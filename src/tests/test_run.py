@@ -0,0 +1,68 @@
+import os
+import sys
+from StringIO import StringIO
+
+import run
+from synthetic import synthesize
+from tests import TemporaryDirectoryTestCase
+
+
+class RunTest(TemporaryDirectoryTestCase):
+    def setUp(self):
+        super(RunTest, self).setUp()
+        self.path = synthesize(os.path.join(self.directory, "a.car"), 4, 3,
+                               fanout=4, payload_size=64, seed=1)
+
+    def run_main(self, *arguments):
+        """
+        Runs run.py with `arguments`, returns its exit status (0 when it
+        returns), stdout and stderr.
+        """
+        saved = sys.argv, sys.stdout, sys.stderr
+        sys.argv = ["run.py"] + list(arguments)
+        sys.stdout, sys.stderr = StringIO(), StringIO()
+        try:
+            run.main()
+            status = 0
+        except SystemExit as error:
+            status = error.code
+        finally:
+            output, errors = sys.stdout.getvalue(), sys.stderr.getvalue()
+            sys.argv, sys.stdout, sys.stderr = saved
+
+        return status, output, errors
+
+    def test_profile(self):
+        status, output, _ = self.run_main(self.path, "-s", "--profile")
+        self.assertEqual(status, 0)
+        self.assertIn("Blocks read:", output)
+
+    def test_profile_needs_a_single_process(self):
+        export = os.path.join(self.directory, "export")
+        for arguments in (("-o", export), ("--scan", self.directory)):
+            status, _, errors = self.run_main(
+                self.path, "--profile", "-j", "2", *arguments)
+            self.assertEqual(status, 2)
+            self.assertIn("--profile only counts this process", errors)
+
+        self.assertFalse(os.path.exists(export))
+
+    def test_keep(self):
+        output = os.path.join(self.directory, "thin.car")
+        status, printed, _ = self.run_main(self.path, "--thin", output,
+                                           "--keep", "scale=2,3")
+        self.assertEqual(status, 0)
+        self.assertIn("Kept 8 renditions, dropped 4", printed)
+
+    def test_invalid_keep(self):
+        output = os.path.join(self.directory, "thin.car")
+        for rule, message in (("scale", "expected attribute=value"),
+                              ("scale=two", "expected attribute=value"),
+                              ("=1", "expected attribute=value"),
+                              ("foo=1", "Unknown rendition attribute foo")):
+            status, _, errors = self.run_main(self.path, "--thin", output,
+                                              "--keep", rule)
+            self.assertEqual(status, 2, rule)
+            self.assertIn(message, errors)
+
+        self.assertFalse(os.path.exists(output))
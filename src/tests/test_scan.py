@@ -0,0 +1,72 @@
+import os
+import sqlite3
+import sys
+from StringIO import StringIO
+
+from scan import scan
+from synthetic import synthesize
+from tests import TemporaryDirectoryTestCase
+
+
+class ScanTest(TemporaryDirectoryTestCase):
+    def setUp(self):
+        super(ScanTest, self).setUp()
+        self.files = os.path.join(self.directory, "files")
+        os.makedirs(os.path.join(self.files, "nested"))
+        synthesize(os.path.join(self.files, "a.car"), 5, 3, fanout=4,
+                   payload_size=64, seed=1)
+        synthesize(os.path.join(self.files, "nested", "b.car"), 7, 2,
+                   fanout=4, payload_size=64, seed=2)
+        with open(os.path.join(self.files, "bad.car"), "wb") as stream:
+            stream.write("not a car file")
+        self.catalogue = os.path.join(self.directory, "catalogue.db")
+
+    def scan(self, jobs=1):
+        stderr, sys.stderr = sys.stderr, StringIO()
+        try:
+            return scan(self.files, self.catalogue, jobs)
+        finally:
+            sys.stderr = stderr
+
+    def query(self, sql):
+        connection = sqlite3.connect(self.catalogue)
+        try:
+            return connection.execute(sql).fetchall()
+        finally:
+            connection.close()
+
+    def test_catalogue(self):
+        self.assertEqual(self.scan(), 2)
+        self.assertEqual(
+            self.query("SELECT path, rendition_count FROM files "
+                       "ORDER BY path"),
+            [(os.path.join(self.files, "a.car"), 15),
+             (os.path.join(self.files, "nested", "b.car"), 14)])
+        self.assertEqual(self.query("SELECT COUNT(*) FROM facets"), [(12,)])
+        self.assertEqual(self.query("SELECT COUNT(*) FROM renditions"),
+                         [(29,)])
+        self.assertEqual(
+            self.query("SELECT COUNT(*) FROM renditions WHERE scale = 2"),
+            [(12,)])
+
+    def test_failures_are_recorded_and_skipped(self):
+        self.scan()
+        failures = self.query("SELECT path, error FROM failures")
+        self.assertEqual([x[0] for x in failures],
+                         [os.path.join(self.files, "bad.car")])
+        self.assertTrue(failures[0][1])
+
+        # Unchanged files, including failed ones, are skipped on re-runs.
+        self.assertEqual(self.scan(), 0)
+
+        synthesize(os.path.join(self.files, "bad.car"), 2, 2, fanout=4,
+                   payload_size=64, seed=3)
+        os.utime(os.path.join(self.files, "bad.car"), (1, 1))
+        self.assertEqual(self.scan(), 1)
+        self.assertEqual(self.query("SELECT COUNT(*) FROM failures"), [(0,)])
+        self.assertEqual(self.query("SELECT COUNT(*) FROM files"), [(3,)])
+
+    def test_process_pool(self):
+        self.assertEqual(self.scan(jobs=2), 2)
+        self.assertEqual(self.query("SELECT COUNT(*) FROM renditions"),
+                         [(29,)])
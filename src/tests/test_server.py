@@ -0,0 +1,61 @@
+import os
+import time
+import unittest
+
+import pixels as vectorised
+
+from server import AssetServer, AssetServerError
+from synthetic import synthesize
+from tests import TemporaryDirectoryTestCase
+
+
+@unittest.skipUnless(vectorised.available, "NumPy is required")
+class AssetServerTest(TemporaryDirectoryTestCase):
+    def setUp(self):
+        super(AssetServerTest, self).setUp()
+        self.path = synthesize(os.path.join(self.directory, "a.car"), 6, 3,
+                               fanout=4, payload_size=64, seed=1)
+        self.server = AssetServer(("127.0.0.1", 0), self.directory, jobs=2)
+
+    def tearDown(self):
+        self.server.server_close()
+        super(AssetServerTest, self).tearDown()
+
+    def test_render(self):
+        content_type, content = self.server.render("a", "facet000002",
+                                                   scale=2)
+        self.assertEqual(content_type, "image/png")
+        self.assertEqual(content[:8], "\x89PNG\r\n\x1a\n")
+
+        # Served from the cache the second time.
+        hits = self.server.cache.hits
+        self.assertEqual(self.server.render("a", "facet000002", scale=2),
+                         (content_type, content))
+        self.assertGreater(self.server.cache.hits, hits)
+        self.assertEqual(self.server.pending, {})
+
+    def test_errors(self):
+        for name, facet, attributes, status in (
+                ("missing", "facet000001", {}, 404),
+                ("a", "missing", {}, 404),
+                ("a", "facet000001", {"scale": 9}, 404)):
+            try:
+                self.server.render(name, facet, **attributes)
+            except AssetServerError as error:
+                self.assertEqual(error.status, status)
+            else:
+                self.fail("%s/%s rendered" % (name, facet))
+
+    def test_refresh(self):
+        self.server.render("a", "facet000001")
+        self.assertEqual(self.server.refresh(), {})
+
+        other = synthesize(os.path.join(self.directory, "b.tmp"), 9, 1,
+                           fanout=4, payload_size=64, seed=2)
+        os.rename(other, self.path)
+        os.utime(self.path, (time.time() + 5,) * 2)
+        changes = self.server.refresh()
+        self.assertIn("RENDITIONS", changes["a"])
+
+        content_type, content = self.server.render("a", "facet000008")
+        self.assertEqual(content_type, "image/png")
@@ -0,0 +1,73 @@
+import os
+import sys
+from StringIO import StringIO
+
+from car import CARFile
+from sidecar import CARSidecar
+from synthetic import synthesize
+from tests import TemporaryDirectoryTestCase
+
+
+class CARSidecarTest(TemporaryDirectoryTestCase):
+    def setUp(self):
+        super(CARSidecarTest, self).setUp()
+        self.path = synthesize(os.path.join(self.directory, "a.car"), 10, 3,
+                               fanout=4, payload_size=64, seed=1)
+        self.sidecar = CARSidecar(os.path.join(self.directory, "sidecars"))
+
+    def test_round_trip(self):
+        plain = CARFile(self.path)
+        CARFile(self.path, sidecar=self.sidecar)
+        self.assertTrue(os.path.exists(self.sidecar.path_for(self.path)))
+
+        car = CARFile(self.path, sidecar=self.sidecar)
+        entry = self.sidecar.load(car)
+        self.assertIsNotNone(entry)
+        self.assertEqual(entry.table, plain.table)
+        self.assertEqual(entry.uuid, plain.header.uuid)
+
+        # The index is restored from the sidecar, not rebuilt.
+        self.assertIn("index", car.snapshot.__dict__)
+        self.assertEqual(car.index.facets, plain.index.facets)
+        self.assertEqual(car.index.renditions, plain.index.renditions)
+        self.assertEqual([x.name for x in car.lookup("facet000004")],
+                         [x.name for x in plain.lookup("facet000004")])
+
+    def test_stale_entry(self):
+        CARFile(self.path, sidecar=self.sidecar)
+        synthesize(self.path, 4, 2, fanout=4, payload_size=64, seed=2)
+        os.utime(self.path, (1, 1))
+
+        car = CARFile(self.path, sidecar=self.sidecar)
+        self.assertEqual(len(car.index.facets), 4)
+        self.assertEqual(len(self.sidecar.load(car).facets), 4)
+
+    def test_saved_after_a_change(self):
+        car = CARFile(self.path)
+        synthesize(self.path, 4, 2, fanout=4, payload_size=64, seed=2)
+        os.utime(self.path, (1, 1))
+
+        # The entry describes the file as `car` read it.
+        self.assertTrue(self.sidecar.save(car))
+        self.assertIsNone(self.sidecar.load(CARFile(self.path)))
+        car = CARFile(self.path, sidecar=self.sidecar)
+        self.assertEqual(len(car.index.facets), 4)
+        self.assertEqual(len(self.sidecar.load(car).facets), 4)
+
+    def test_unwritable_directory(self):
+        # A file where the sidecar directory should be.
+        blocked = os.path.join(self.directory, "blocked")
+        open(blocked, "w").close()
+        sidecar = CARSidecar(blocked)
+
+        stderr, sys.stderr = sys.stderr, StringIO()
+        try:
+            car = CARFile(self.path, sidecar=sidecar)
+            self.assertFalse(sidecar.save(car))
+        finally:
+            output, sys.stderr = sys.stderr.getvalue(), stderr
+
+        self.assertIn("Not caching", output)
+        self.assertEqual(len(car.lookup("facet000001")), 3)
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ["a.car", "blocked"])
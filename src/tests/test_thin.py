@@ -0,0 +1,85 @@
+import os
+import struct
+
+from car import CARFile, BLOCK_CARHEADER, BLOCK_FACET_KEYS, \
+                BLOCK_KEY_FORMAT, BLOCK_RENDITIONS
+from synthetic import synthesize, pack_header, pack_key_format, \
+                      pack_facet, pack_rendition, rendition_attributes, \
+                      SYNTHETIC_IDENTIFIERS
+from tests import TemporaryDirectoryTestCase, state
+from thin import thin
+from writer import BOMWriter
+
+
+class ThinTest(TemporaryDirectoryTestCase):
+    def setUp(self):
+        super(ThinTest, self).setUp()
+        self.path = synthesize(os.path.join(self.directory, "a.car"), 10, 6,
+                               fanout=4, payload_size=64, seed=1)
+        self.car = CARFile(self.path)
+
+    def test_keeps_matching_renditions(self):
+        output = os.path.join(self.directory, "thin.car")
+        counts = thin(self.car, output, scale=2, idiom=[0, 1])
+
+        expected = list(self.car.iter_renditions(
+            where={"scale": 2, "idiom": [0, 1]}))
+        self.assertEqual(counts["kept"], len(expected))
+        self.assertEqual(counts["dropped"], 60 - len(expected))
+
+        thinned = CARFile(output)
+        self.assertEqual(thinned.header.rendition_count, len(expected))
+        self.assertEqual([state(x) for x in thinned.iter_renditions()],
+                         [state(x) for x in expected])
+        self.assertEqual(thinned.index.facets, self.car.index.facets)
+
+    def test_drops_empty_facets(self):
+        output = os.path.join(self.directory, "thin.car")
+        # Only variants 3 to 5 of each facet have idiom 1.
+        thin(self.car, output, idiom=1)
+        thinned = CARFile(output)
+        self.assertEqual(len(list(thinned.iter_renditions())), 30)
+
+        thin(self.car, output, dimension1=1)
+        thinned = CARFile(output)
+        self.assertEqual(list(thinned.iter_renditions()), [])
+        self.assertEqual(list(thinned.facets), [])
+
+    def test_dedupe(self):
+        path = os.path.join(self.directory, "shared.car")
+        value = pack_rendition("shared.png", 4, 4, 1, "\xff" * 64)
+        writer = BOMWriter()
+        writer.name(BLOCK_CARHEADER, writer.add(pack_header(3)))
+        writer.name(BLOCK_KEY_FORMAT,
+                    writer.add(pack_key_format(SYNTHETIC_IDENTIFIERS)))
+        writer.name(BLOCK_FACET_KEYS, writer.add_tree(
+            [("shared", pack_facet(1))]))
+        writer.name(BLOCK_RENDITIONS, writer.add_tree(
+            [(struct.pack("<7H", *rendition_attributes(0, variant)), value)
+             for variant in range(3)]))
+        writer.write(path)
+
+        shared = os.path.join(self.directory, "dedupe.car")
+        copied = os.path.join(self.directory, "copy.car")
+        self.assertEqual(thin(CARFile(path), shared)["shared"], 2)
+        self.assertEqual(thin(CARFile(path), copied, dedupe=False)["shared"],
+                         0)
+        self.assertGreaterEqual(
+            os.path.getsize(copied) - os.path.getsize(shared), 2 * len(value))
+        self.assertEqual([str(x.content) for x in
+                          CARFile(shared).iter_renditions()],
+                         [str(x.content) for x in
+                          CARFile(path).iter_renditions()])
+
+    def test_onto_itself(self):
+        expected = [state(x) for x in self.car.iter_renditions(
+            where={"scale": 2})]
+        counts = thin(self.car, self.path, scale=2)
+        self.assertEqual(counts["kept"], len(expected))
+        self.assertEqual(os.listdir(self.directory), ["a.car"])
+
+        # The open file keeps reading the previous content.
+        self.assertEqual(len(list(self.car.iter_renditions())), 60)
+        thinned = CARFile(self.path)
+        self.assertEqual([state(x) for x in thinned.iter_renditions()],
+                         expected)
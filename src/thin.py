@@ -0,0 +1,74 @@
+import struct
+
+from bom_models import BOMTree
+from car import BLOCK_CARHEADER, BLOCK_FACET_KEYS, BLOCK_RENDITIONS
+from index import key_filter
+from writer import BOMWriter
+
+
+# Offset of `rendition_count` in CARHEADER, after magic, versions and stamp.
+RENDITION_COUNT_OFFSET = 16
+
+
+def thin(car, path, fanout=64, dedupe=True, **keep):
+    """
+    Re-emits `car` into `path` keeping only the renditions whose attributes
+    are in the given values, e.g. `thin(car, path, idiom=[0, 1], scale=2)`
+    for iPhone 2x artwork. Facets left without renditions are dropped and
+    every other named block is copied, trees being rebuilt entry by entry.
+
+    Trees are written balanced with each leaf right before its keys and
+    values, so iterating the output reads it front to back. With `dedupe`
+    byte-identical rendition values are stored in a single block shared by
+    all their keys.
+
+    `path` may be the file of `car` itself, which is replaced once the new
+    content is complete. Returns a dict with the number of `kept`, `dropped`
+    and `shared` renditions.
+    """
+    car = car.snapshot
+    index = car.index
+    matches = key_filter(index.identifiers, keep)
+    renditions = []
+    identifiers = set()
+    dropped = 0
+    tree = BOMTree.make(car._stream_named(BLOCK_RENDITIONS).stream)
+    for key, value_index in tree.iterate_keys(car._stream_index):
+        values = index.key_layout.unpack(key)
+        if not matches(values):
+            dropped += 1
+            continue
+
+        stream, block = car._stream_index(value_index)
+        renditions.append((key, stream.view(block.size)))
+        identifiers.add(values[index.identifier_index])
+
+    writer = BOMWriter()
+    for name, block_index in sorted(car.table.iteritems(),
+                                    key=lambda x: x[1]):
+        if name == BLOCK_CARHEADER:
+            stream, block = car._stream_index(block_index)
+            header = stream.view(block.size)
+            writer.name(name, writer.add(
+                header[:RENDITION_COUNT_OFFSET] +
+                struct.pack("<I", len(renditions)) +
+                header[RENDITION_COUNT_OFFSET + 4:]))
+        elif name == BLOCK_RENDITIONS:
+            writer.name(name, writer.add_tree(renditions, fanout, dedupe))
+        elif name == BLOCK_FACET_KEYS:
+            facets = [(key, value) for key, value in
+                      car._tree_at(block_index).iterate(car._stream_index)
+                      if index.facets.get(key) in identifiers]
+            writer.name(name, writer.add_tree(facets, fanout))
+        else:
+            tree = car._tree_at(block_index)
+            if tree is None:
+                stream, block = car._stream_index(block_index)
+                writer.name(name, writer.add(stream.view(block.size)))
+            else:
+                items = list(tree.iterate(car._stream_index))
+                writer.name(name, writer.add_tree(items, fanout))
+
+    writer.write(path)
+    return {"kept": len(renditions), "dropped": dropped,
+            "shared": writer.shared}
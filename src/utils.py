@@ -18,3 +18,17 @@ class cached_property(object):
         setattr(instance, self._attr_name, attr)
 
         return attr
+
+
+class locked_cached_property(cached_property):
+    """
+    `cached_property` built under the instance `_lock`, so threads racing on
+    first use wait for a single build instead of each repeating it.
+    """
+    def __get__(self, instance, owner):
+        with instance._lock:
+            # Built by another thread while we were waiting.
+            if self._attr_name in instance.__dict__:
+                return instance.__dict__[self._attr_name]
+
+            return super(locked_cached_property, self).__get__(instance, owner)
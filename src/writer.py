@@ -0,0 +1,165 @@
+import cStringIO as StringIO
+import hashlib
+import os
+import struct
+
+from bom_models import BOMHeader, BOMBlock, BOMPathIndex, BOMTree
+
+
+BOM_HEADER_SIZE = 512
+BOM_TREE_BLOCK_SIZE = 4096
+
+
+class BOMWriter(object):
+    """
+    Assembles a BOMStore file: numbered blocks, named entries in the table of
+    contents and B+ trees built from BOMTree/BOMPath blocks. Block 0 is the
+    null block, as in files written by Apple tools.
+    """
+
+    def __init__(self):
+        self.blocks = [""]
+        self.table = []
+        # Values shared with an identical one by `add_tree(dedupe=True)`.
+        self.shared = 0
+
+    def add(self, content):
+        """
+        Appends a block and returns its index.
+        """
+        self.blocks.append(content)
+        return len(self.blocks) - 1
+
+    def name(self, name, index):
+        """
+        Adds the block `index` to the table of contents as `name`.
+        """
+        self.table.append((name, index))
+
+    def add_tree(self, items, fanout=64, dedupe=False):
+        """
+        Writes a balanced tree holding `items`, (key, value) pairs where both
+        are either raw bytes (str or buffer) or the index of an existing
+        block. Leaves hold up to `fanout` entries and are chained with
+        `forward`/`backwards` links; non-leaf entries are keyed by the last
+        key of their child. Each leaf is laid out right before its keys and
+        values, the order they are read when walking the tree.
+
+        With `dedupe` identical values are stored once and shared by all
+        their keys. Returns the index of the BOMTree block.
+        """
+        items = sorted(items, key=lambda item: str(self._content(item[0])))
+        fanout = max(fanout, 2)
+        shared = {}
+
+        leaves = []
+        for start in xrange(0, max(len(items), 1), fanout):
+            chunk = items[start:start + fanout]
+            leaf = self.add("")
+            indexes = []
+            for key, value in chunk:
+                key_index = self._block(key)
+                if dedupe and not isinstance(value, (int, long)):
+                    digest = hashlib.sha1(value).digest()
+                    if digest not in shared:
+                        shared[digest] = self.add(value)
+                    else:
+                        self.shared += 1
+
+                    value = shared[digest]
+
+                indexes.append(BOMPathIndex(value_index=self._block(value),
+                                            key_index=key_index))
+
+            last = str(self._content(chunk[-1][0])) if chunk else ""
+            leaves.append((leaf, indexes, last))
+
+        for i, (index, indexes, _) in enumerate(leaves):
+            forward = leaves[i + 1][0] if i + 1 < len(leaves) else 0
+            backwards = leaves[i - 1][0] if i else 0
+            self.blocks[index] = self._path(True, forward, backwards, indexes)
+
+        level = [(index, last) for index, _, last in leaves]
+        while len(level) > 1:
+            parents = []
+            for start in xrange(0, len(level), fanout):
+                chunk = level[start:start + fanout]
+                indexes = [BOMPathIndex(value_index=child,
+                                        key_index=self.add(last))
+                           for child, last in chunk]
+                parents.append((self.add(self._path(False, 0, 0, indexes)),
+                                chunk[-1][1]))
+
+            level = parents
+
+        tree = BOMTree(magic="tree", version=1, child=level[0][0],
+                       block_size=BOM_TREE_BLOCK_SIZE, path_count=len(items),
+                       unknown=0)
+        return self.add(tree.pack())
+
+    def tostring(self):
+        stream = StringIO.StringIO()
+        self.dump(stream)
+        return stream.getvalue()
+
+    def write(self, path):
+        """
+        Writes the file into `path` through a temporary file renamed into
+        place, so `path` can be the file the blocks are views of: its mapping
+        keeps the previous content while the new one is written.
+        """
+        temporary = "%s.%d.tmp" % (path, os.getpid())
+        try:
+            with open(temporary, "wb") as stream:
+                self.dump(stream)
+
+            os.rename(temporary, path)
+        except Exception:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+
+    def dump(self, stream):
+        """
+        Writes the file into `stream`. Blocks are laid out after the header
+        in index order and written one by one, so buffers over another file
+        are never copied as a whole.
+        """
+        offset = BOM_HEADER_SIZE
+        locations = [BOMBlock(index=0, size=0)]
+        for block in self.blocks[1:]:
+            locations.append(BOMBlock(index=offset, size=len(block)))
+            offset += len(block)
+
+        index = struct.pack(">I", len(locations)) + \
+            "".join(location.pack() for location in locations)
+        table = struct.pack(">I", len(self.table)) + \
+            "".join(struct.pack(">IB", index, len(name)) + name
+                    for name, index in self.table)
+
+        header = BOMHeader(magic="BOMStore", version=1,
+                           block_count=len(self.blocks) - 1,
+                           index_offset=offset, index_size=len(index),
+                           table_offset=offset + len(index),
+                           table_size=len(table))
+        stream.write(header.pack().ljust(BOM_HEADER_SIZE, "\x00"))
+        for block in self.blocks[1:]:
+            stream.write(block)
+
+        stream.write(index)
+        stream.write(table)
+
+    # - Private helpers
+
+    def _block(self, content):
+        return content if isinstance(content, (int, long)) else \
+            self.add(content)
+
+    def _content(self, content):
+        return self.blocks[content] if isinstance(content, (int, long)) else \
+            content
+
+    def _path(self, is_leaf, forward, backwards, indexes):
+        return struct.pack(">HHII", int(is_leaf), len(indexes), forward,
+                           backwards) + \
+            "".join(index.pack() for index in indexes)